@@ -0,0 +1,82 @@
+"""Общая подготовка для бенчмарков: окружение, временная БД, импорт бота."""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_bot(db_path: str = ""):
+    # opt_bot читает конфиг при импорте, поэтому окружение задаём заранее
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("MANAGER_ID", "1")
+    # синтетические пользователи шлют апдейты подряд; антифлуд исказил бы замеры
+    os.environ.setdefault("THROTTLE_RATE", "0")
+    # и темп исходящих: фейковая сессия не ограничена, меряем сам бот
+    os.environ.setdefault("SEND_RATE", "0")
+    # feed_update должен возвращаться после обработки, иначе замеры хендлеров теряют смысл
+    os.environ.setdefault("UPDATE_WORKERS", "0")
+    os.environ["DB_PATH"] = db_path or str(Path(tempfile.mkdtemp(prefix="zary-bench-")) / "bench.sqlite3")
+    if str(ROOT) not in sys.path:
+        sys.path.insert(0, str(ROOT))
+    import opt_bot
+    return opt_bot
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def make_fake_session(latency: float = 0.0):
+    """Сессия Bot API, которая отвечает сразу (или через latency секунд) без сети."""
+    import asyncio
+    import itertools
+    from datetime import datetime
+
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, Message
+
+    class FakeSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls = 0
+            self._ids = itertools.count(1)
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls += 1
+            if latency:
+                await asyncio.sleep(latency)
+            returning = getattr(method, "__returning__", None)
+            if returning is Message:
+                return Message(
+                    message_id=next(self._ids),
+                    date=datetime.now(),
+                    chat=Chat(id=getattr(method, "chat_id", 0) or 0, type="private"),
+                    text=getattr(method, "text", None),
+                )
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            if False:
+                yield b""
+
+        async def close(self):
+            pass
+
+    return FakeSession()
+
+
+def install_fake_session(bot, latency: float = 0.0):
+    session = make_fake_session(latency)
+    # сохраняем middleware бота (метрики, трассировка)
+    session.middleware = bot.session.middleware
+    bot.session = session
+    return session
@@ -0,0 +1,194 @@
+"""Масштабный бенчмарк методов Database и генерации отчётов.
+
+Для каждого размера создаётся отдельная БД с N синтетическими заявками и
+N записями activity_log; замеряются время и пиковая память (tracemalloc)
+каждого пути. Результат пишется в JSON, который можно сравнить с прошлым
+прогоном.
+
+    python bench/db_scale.py --sizes 10000,100000,1000000 --out scale.json
+    python bench/db_scale.py --sizes 10000 --compare scale.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from common import install_fake_session, load_bot
+
+opt_bot = load_bot()
+
+STATUSES = ["new", "work", "paid", "shipped", "closed"]
+CITIES = ["Ташкент", "Самарканд", "Бухара", "Андижан", "Наманган", "Фергана", "Нукус"]
+
+
+def seed(db_path: str, n: int, seed_value: int = 1):
+    rnd = random.Random(seed_value)
+    now = datetime.now()
+    # заявки за последние ~13 месяцев, по возрастанию времени (как пишет бот)
+    start = now - timedelta(days=400)
+    step = (now - start) / n
+    conn = sqlite3.connect(db_path)
+    try:
+        batch, activity = [], []
+        for i in range(n):
+            ts = (start + step * i).strftime("%Y-%m-%d %H:%M:%S")
+            user_id = rnd.randint(1, max(n // 3, 1))
+            batch.append((
+                ts, user_id, f"user{user_id}", f"Client {user_id}", rnd.choice(["ru", "uz"]),
+                rnd.choice(["🏬 Бутик", "🏪 Магазин", "📱 Маркетплейс"]),
+                rnd.choice(["👕 Одежда", "👖 Брюки", "🎒 Аксессуары"]),
+                rnd.choice(["20–50", "50–100", "100–300", "300+"]),
+                rnd.choice(CITIES), f"+99890{rnd.randint(1000000, 9999999)}",
+                rnd.choice(STATUSES), 1,
+            ))
+            activity.append((ts, user_id, rnd.choice(["start", "set_lang", "lead_created"]), ""))
+            if len(batch) >= 50_000:
+                _flush(conn, batch, activity)
+                batch, activity = [], []
+        _flush(conn, batch, activity)
+    finally:
+        conn.close()
+
+
+def _flush(conn, leads, activity):
+    conn.executemany(
+        """
+        INSERT INTO leads(created_at, user_id, username, full_name, lang, role, product,
+                          qty, city, phone, status, manager_notified)
+        VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+        """,
+        leads,
+    )
+    conn.executemany(
+        "INSERT INTO activity_log (timestamp, user_id, action, details) VALUES(?,?,?,?)",
+        activity,
+    )
+    conn.commit()
+
+
+def operations(db, workdir: Path):
+    now = datetime.now()
+
+    async def monthly_report():
+        # иначе повторный прогон пропустит уже «отправленный» отчёт
+        await db.conn.execute("DELETE FROM monthly_reports")
+        await db.conn.commit()
+        await opt_bot.send_monthly_report()
+
+    return {
+        "get_stats": lambda: db.get_stats(),
+        "get_monthly_stats": lambda: db.get_monthly_stats(now.year, now.month),
+        "get_leads_page": lambda: db.get_leads_page({"status": "new"}, None, False, 10),
+        "create_excel": lambda: opt_bot.create_excel(workdir / "bench.xlsx", "Leads"),
+        "send_monthly_report": monthly_report,
+    }
+
+
+async def measure(fn, with_memory: bool) -> dict:
+    if with_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    result = await fn()
+    wall = time.perf_counter() - started
+    entry = {"wall_s": wall}
+    if with_memory:
+        entry["peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    del result
+    return entry
+
+
+async def bench_size(n: int, with_memory: bool) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix=f"zary-scale-{n}-"))
+    os.chdir(workdir)  # reports создаются относительно cwd
+    db_path = str(workdir / "bench.sqlite3")
+
+    db = opt_bot.Database(db_path)
+    await db.connect()
+    await db.close()
+
+    started = time.perf_counter()
+    seed(db_path, n)
+    seed_s = time.perf_counter() - started
+
+    db = opt_bot.Database(db_path)
+    opt_bot.db = db  # create_excel и send_monthly_report берут модульный db
+    await db.connect()
+    try:
+        results = {"seed_s": seed_s, "ops": {}}
+        for name, fn in operations(db, workdir).items():
+            timing = await measure(fn, with_memory=False)
+            if with_memory:
+                timing["peak_mb"] = (await measure(fn, with_memory=True))["peak_mb"]
+            results["ops"][name] = timing
+            print(f"  {name:<26}{timing['wall_s'] * 1000:>12.1f} ms"
+                  + (f"{timing['peak_mb']:>10.1f} MB" if with_memory else ""))
+        results["db_size_mb"] = Path(db_path).stat().st_size / 1024 / 1024
+        return results
+    finally:
+        await db.close()
+
+
+def compare(current: dict, baseline: dict):
+    print(f"\n{'size':>9} {'operation':<26}{'baseline':>12}{'current':>12}{'ratio':>8}")
+    for size, data in current["results"].items():
+        base = baseline.get("results", {}).get(size)
+        if not base:
+            continue
+        for op, timing in data["ops"].items():
+            old = base["ops"].get(op)
+            if not old:
+                continue
+            ratio = timing["wall_s"] / old["wall_s"] if old["wall_s"] else float("inf")
+            print(f"{size:>9} {op:<26}{old['wall_s'] * 1000:>10.1f}ms{timing['wall_s'] * 1000:>10.1f}ms{ratio:>7.2f}x")
+
+
+async def run(args) -> dict:
+    install_fake_session(opt_bot.bot)
+    sizes = [int(x) for x in args.sizes.split(",") if x.strip()]
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "results": {},
+    }
+    for n in sizes:
+        print(f"size={n}")
+        report["results"][str(n)] = await bench_size(n, with_memory=not args.no_memory)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--out", default="bench_db_scale.json")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--no-memory", action="store_true", help="не делать проход с tracemalloc")
+    args = parser.parse_args()
+    out = Path(args.out).resolve()
+    baseline = Path(args.compare).resolve() if args.compare else None
+
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    out.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\nsaved: {out}")
+    if baseline:
+        compare(report, json.loads(baseline.read_text(encoding="utf-8")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Проверка group commit: N одновременных submit_lead должны уйти одним COMMIT.
+
+Коммиты считаются по WAL: у последнего кадра каждой транзакции в заголовке
+записан размер БД после коммита (ненулевой), у остальных кадров там 0.
+
+    python bench/group_commit.py --leads 20
+"""
+
+import argparse
+import asyncio
+import struct
+import sys
+from pathlib import Path
+
+from common import load_bot
+
+opt_bot = load_bot()
+
+WAL_HEADER = 32
+FRAME_HEADER = 24
+
+
+def count_wal_commits(wal_path: Path) -> int:
+    data = wal_path.read_bytes()
+    if len(data) < WAL_HEADER:
+        return 0
+    page_size = struct.unpack(">I", data[8:12])[0]
+    salt = data[16:24]
+    commits = 0
+    offset = WAL_HEADER
+    while offset + FRAME_HEADER + page_size <= len(data):
+        frame = data[offset:offset + FRAME_HEADER]
+        # кадры от прошлых поколений WAL (другая соль) не считаются
+        if frame[8:16] != salt:
+            break
+        if struct.unpack(">I", frame[4:8])[0]:
+            commits += 1
+        offset += FRAME_HEADER + page_size
+    return commits
+
+
+def lead(i: int) -> dict:
+    return {
+        "created_at": opt_bot.utc_timestamp(), "user_id": 500_000 + i, "username": f"gc{i}",
+        "full_name": f"GC {i}", "lang": "ru", "role": "🏬 Бутик", "product": "👕 Одежда",
+        "qty": "20–50", "city": "Ташкент", "phone": f"+99890{i:07d}",
+    }
+
+
+async def run(n: int) -> int:
+    db = opt_bot.db
+    await db.connect()
+    try:
+        # фоновые записи activity_log не должны попасть в подсчёт
+        await db.activity.stop()
+        async with db.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cur:
+            await cur.fetchall()
+        commits_before = db.writer.commits
+
+        await asyncio.gather(*(db.submit_lead(lead(i)) for i in range(n)))
+
+        wal_commits = count_wal_commits(Path(db.db_path + "-wal"))
+        counted = db.writer.commits - commits_before
+        print(f"leads={n} wal_commits={wal_commits} writer.commits={counted}")
+        if wal_commits != counted or wal_commits > 1:
+            print("FAIL: batch was not committed as a single transaction")
+            return 1
+        print("OK")
+        return 0
+    finally:
+        await db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--leads", type=int, default=20)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.leads)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Синтетическая нагрузка на dp.feed_update: /start, кнопки меню и анкета до form_phone.
+
+Временная SQLite, фейковая сессия Bot API. Отчёт: пропускная способность и
+p50/p95/p99 по хендлерам.
+
+    python bench/loadtest.py --users 500 --concurrency 50 [--api-latency-ms 0] [--json out.json]
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+
+from common import install_fake_session, load_bot, percentile
+
+opt_bot = load_bot()
+
+from aiogram import BaseMiddleware  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+_ids = itertools.count(1)
+
+
+def message_update(user_id: int, text: str = None, contact: str = None, lang: str = "ru") -> Update:
+    message = {
+        "message_id": next(_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"User{user_id}",
+            "username": f"user{user_id}",
+            "language_code": lang,
+        },
+    }
+    if text is not None:
+        message["text"] = text
+    if contact:
+        message["contact"] = {"phone_number": contact, "first_name": "User", "user_id": user_id}
+    return Update.model_validate({"update_id": next(_ids), "message": message})
+
+
+def user_script(user_id: int, rnd: random.Random) -> list:
+    lang = rnd.choice(["ru", "uz"])
+    b = opt_bot.BTN[lang]
+    menu = ["catalog", "terms", "why", "min", "manager", "channel"]
+    script = [message_update(user_id, "/start", lang=lang)]
+    for key in rnd.sample(menu, 3):
+        script.append(message_update(user_id, b[key], lang=lang))
+    script.append(message_update(user_id, b["leave"], lang=lang))
+    for text in ("🏬 Бутик", "👕 Одежда", "20–50", "Ташкент"):
+        script.append(message_update(user_id, text, lang=lang))
+    phone = f"+99890{rnd.randint(1000000, 9999999)}"
+    if rnd.random() < 0.5:
+        script.append(message_update(user_id, contact=phone, lang=lang))
+    else:
+        script.append(message_update(user_id, phone, lang=lang))
+    return script
+
+
+class TimingMiddleware(BaseMiddleware):
+    def __init__(self, samples: dict):
+        self.samples = samples
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            name = opt_bot.handler_name(data)
+            self.samples.setdefault(name, []).append(time.perf_counter() - started)
+
+
+async def run(args) -> dict:
+    bot, dp, db = opt_bot.bot, opt_bot.dp, opt_bot.db
+    session = install_fake_session(bot, args.api_latency_ms / 1000)
+    samples: dict = {}
+    dp.message.middleware(TimingMiddleware(samples))
+
+    await db.connect()
+    rnd = random.Random(args.seed)
+    scripts = [user_script(100_000 + i, rnd) for i in range(args.users)]
+    sem = asyncio.Semaphore(args.concurrency)
+    update_latency = []
+
+    async def simulate(script):
+        async with sem:
+            # апдейты одного чата строго по порядку, как в Telegram
+            for update in script:
+                started = time.perf_counter()
+                await dp.feed_update(bot, update)
+                update_latency.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate(s) for s in scripts))
+    wall = time.perf_counter() - started
+
+    await opt_bot.fsm_storage.close()
+    leads = (await db.get_stats()).get("total_leads", 0)
+    await db.close()
+
+    handlers = {
+        name: {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+        for name, values in sorted(samples.items())
+    }
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "api_latency_ms": args.api_latency_ms,
+        "updates": len(update_latency),
+        "api_calls": session.calls,
+        "leads": leads,
+        "wall_s": wall,
+        "updates_per_s": len(update_latency) / wall if wall else 0.0,
+        "update_p50_ms": percentile(update_latency, 50) * 1000,
+        "update_p95_ms": percentile(update_latency, 95) * 1000,
+        "update_p99_ms": percentile(update_latency, 99) * 1000,
+        "handlers": handlers,
+    }
+
+
+def print_report(r: dict):
+    print(f"users={r['users']} concurrency={r['concurrency']} api_latency={r['api_latency_ms']}ms")
+    print(f"updates={r['updates']} api_calls={r['api_calls']} leads={r['leads']} wall={r['wall_s']:.2f}s")
+    print(f"throughput: {r['updates_per_s']:.0f} updates/s | "
+          f"update p50={r['update_p50_ms']:.2f} p95={r['update_p95_ms']:.2f} p99={r['update_p99_ms']:.2f} ms")
+    print(f"\n{'handler':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, h in r["handlers"].items():
+        print(f"{name:<16}{h['count']:>8}{h['p50_ms']:>10.2f}{h['p95_ms']:>10.2f}{h['p99_ms']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--api-latency-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результат в JSON")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
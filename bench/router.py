@@ -0,0 +1,81 @@
+"""Стоимость маршрутизации текстового апдейта: цепочка lambda-фильтров vs ButtonRouter.
+
+    python bench/router.py [--iterations 200000]
+"""
+
+import argparse
+import time
+
+from common import load_bot
+
+bot_module = load_bot()
+BTN = bot_module.BTN
+buttons = bot_module.buttons
+
+
+def legacy_filters():
+    # порядок и форма фильтров как до ButtonRouter
+    return [
+        lambda m: (m.text or "") in ["🇷🇺 Русский", "🇺🇿 O'zbekcha"],
+        lambda m: (m.text or "") in {BTN["ru"]["lang"], BTN["uz"]["lang"]},
+        lambda m: (m.text or "") in {BTN["ru"]["manager"], BTN["uz"]["manager"]},
+        lambda m: (m.text or "") in {BTN["ru"]["channel"], BTN["uz"]["channel"]},
+        lambda m: (m.text or "") in {BTN["ru"]["catalog"], BTN["uz"]["catalog"]},
+        lambda m: (m.text or "") in {BTN["ru"]["terms"], BTN["uz"]["terms"]},
+        lambda m: (m.text or "") in {BTN["ru"]["why"], BTN["uz"]["why"]},
+        lambda m: (m.text or "") in {BTN["ru"]["min"], BTN["uz"]["min"]},
+        lambda m: (m.text or "") in {BTN["ru"]["leave"], BTN["uz"]["leave"]},
+        lambda m: (m.text or "") in {BTN["ru"]["cancel"], BTN["uz"]["cancel"]},
+        lambda m: (m.text or "") in {BTN["ru"]["admin"], BTN["uz"]["admin"]},
+        lambda m: (m.text or "").startswith("📋"),
+        lambda m: (m.text or "").startswith("📊"),
+        lambda m: (m.text or "") == "📤 Excel",
+        lambda m: (m.text or "") in {BTN["ru"]["back"], BTN["uz"]["back"]},
+    ]
+
+
+class FakeMessage:
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+
+def run_legacy(filters, messages):
+    for m in messages:
+        for f in filters:
+            if f(m):
+                break
+
+
+def run_router(messages):
+    for m in messages:
+        buttons(m)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+
+    texts = [v for lang in BTN.values() for v in lang.values()]
+    # обычный текст (город, телефон) проходит всю цепочку без совпадений
+    texts += ["Ташкент", "+998901234567"]
+    messages = [FakeMessage(texts[i % len(texts)]) for i in range(args.iterations)]
+    filters = legacy_filters()
+
+    results = {}
+    for name, fn in (("lambda chain", lambda: run_legacy(filters, messages)),
+                     ("ButtonRouter", lambda: run_router(messages))):
+        fn()  # прогрев
+        started = time.perf_counter()
+        fn()
+        results[name] = (time.perf_counter() - started) / len(messages) * 1e9
+
+    for name, ns in results.items():
+        print(f"{name:>14}: {ns:8.1f} ns/update")
+    print(f"{'speedup':>14}: {results['lambda chain'] / results['ButtonRouter']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,37 +3,65 @@ ZARY & CO OPT Bot — Render Production (Fixed)
 - Работает с Render (health server + polling)
 - Async SQLite через aiosqlite
 - Месячный авто-отчет в последний день месяца 23:00
-- Экспорт Excel по кнопке
+- Экспорт по кнопке: CSV, CSV.gz, JSONL или Excel
 - Исправлены отсутствующие тексты/ключи и админ-статистика
 - Админ определяется по MANAGER_ID или ADMIN_ID_1/2/3
 """
 
 import os
 import re
+import html
+import json
+import time
+import signal
+import sqlite3
 import asyncio
 import logging
+import secrets
+import gzip
+import shutil
+import inspect
+import functools
+import contextlib
+import contextvars
+import heapq
+import io
+import csv
+import tempfile
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, BinaryIO
 from calendar import monthrange
 
 import aiosqlite
 from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart, Command
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import (
+    Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton,
+    InlineKeyboardMarkup, InlineKeyboardButton, Update,
+)
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types.input_file import FSInputFile
-from aiogram.exceptions import TelegramAPIError
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey, StateType
+from aiogram.types.input_file import BufferedInputFile, FSInputFile, InputFile
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
 
 
 # =========================
@@ -62,13 +90,78 @@ class Config:
 
     DB_PATH = (os.getenv("DB_PATH") or "leads.sqlite3").strip()
 
-    EXPORTS_DIR = Path("exports")
+    # режим получения апдейтов: polling (по умолчанию) или webhook
+    UPDATES_MODE = (os.getenv("UPDATES_MODE") or "polling").strip().lower()
+    # Render сам выставляет RENDER_EXTERNAL_URL
+    WEBHOOK_BASE_URL = (os.getenv("WEBHOOK_BASE_URL") or os.getenv("RENDER_EXTERNAL_URL") or "").strip().rstrip("/")
+    WEBHOOK_PATH = (os.getenv("WEBHOOK_PATH") or "/telegram/webhook").strip()
+    # если не задан — генерируется при каждом старте (webhook всё равно переустанавливается)
+    WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip() or secrets.token_urlsafe(32)
+
     BACKUP_DIR = Path("backups")
     REPORTS_DIR = Path("reports")
-
-    MAX_EXPORT_AGE_DAYS = 7
+    ARCHIVE_DIR = Path("archive")
+
+    LEADS_PAGE_SIZE = 10
+    # сколько первых строк используется для подбора ширины колонок
+    EXPORT_WIDTH_SAMPLE = 1000
+    EXPORT_FETCH_SIZE = 1000
+    # выгрузка собирается в памяти до этого размера, дальше — во временном файле
+    EXPORT_SPOOL_MB = int((os.getenv("EXPORT_SPOOL_MB") or "16").strip())
+    # лимит Bot API на отправку файла
+    EXPORT_MAX_UPLOAD_MB = 50
     BACKUP_KEEP_COUNT = 5
 
+    # антифлуд: токенов в секунду и размер всплеска на пользователя (админы не ограничиваются)
+    THROTTLE_RATE = float((os.getenv("THROTTLE_RATE") or "1").strip())  # 0 — выключить
+    THROTTLE_BURST = float((os.getenv("THROTTLE_BURST") or "5").strip())
+    THROTTLE_MAX_USERS = int((os.getenv("THROTTLE_MAX_USERS") or "100000").strip())
+
+    # обработка апдейтов: параллельно по чатам, по порядку внутри чата (0 — как в aiogram по умолчанию)
+    UPDATE_WORKERS = int((os.getenv("UPDATE_WORKERS") or "16").strip())
+    UPDATE_QUEUE_LIMIT = int((os.getenv("UPDATE_QUEUE_LIMIT") or "1000").strip())
+    # сверх этого апдейты одного чата отбрасываются, чтобы зависший чат не занял всю очередь
+    UPDATE_CHAT_QUEUE_LIMIT = int((os.getenv("UPDATE_CHAT_QUEUE_LIMIT") or "20").strip())
+
+    # трассировка: порог медленного апдейта и сколько последних хранить для /slow
+    SLOW_UPDATE_MS = float((os.getenv("SLOW_UPDATE_MS") or "1000").strip())
+    SLOW_TRACE_KEEP = int((os.getenv("SLOW_TRACE_KEEP") or "20").strip())
+
+    # кэш языка пользователей (LRU + TTL)
+    LANG_CACHE_SIZE = int((os.getenv("LANG_CACHE_SIZE") or "50000").strip())
+    LANG_CACHE_TTL = int((os.getenv("LANG_CACHE_TTL") or "3600").strip())
+
+    # буферизованная запись activity_log
+    ACTIVITY_BATCH_SIZE = int((os.getenv("ACTIVITY_BATCH_SIZE") or "200").strip())
+    ACTIVITY_FLUSH_INTERVAL = float((os.getenv("ACTIVITY_FLUSH_INTERVAL") or "2").strip())
+    # старше скольких дней activity_log уезжает в архив; удаление пачками с паузой (сек)
+    ACTIVITY_RETENTION_DAYS = int((os.getenv("ACTIVITY_RETENTION_DAYS") or "90").strip())
+    ACTIVITY_ARCHIVE_BATCH = int((os.getenv("ACTIVITY_ARCHIVE_BATCH") or "1000").strip())
+    ACTIVITY_ARCHIVE_PAUSE = 0.05
+
+    # окно group commit для записей (мс)
+    GROUP_COMMIT_WINDOW_MS = float((os.getenv("GROUP_COMMIT_WINDOW_MS") or "2").strip())
+
+    # read-only соединения для админских запросов, отчётов и экспорта (0 — всё через writer)
+    DB_READ_POOL_SIZE = int((os.getenv("DB_READ_POOL_SIZE") or "2").strip())
+
+    # исходящие: общий лимит (сообщений/сек, 0 — без лимита), лимит на чат и повторы
+    SEND_RATE = float((os.getenv("SEND_RATE") or "30").strip())
+    SEND_CHAT_RATE = float((os.getenv("SEND_CHAT_RATE") or "1").strip())
+    SEND_CHAT_BURST = int((os.getenv("SEND_CHAT_BURST") or "5").strip())
+    # в группах Telegram пускает ~20 сообщений в минуту
+    SEND_GROUP_RATE = 20 / 60
+    SEND_MAX_RETRIES = int((os.getenv("SEND_MAX_RETRIES") or "3").strip())
+
+    # рассылка: получателей за пачку (после каждой — checkpoint) и период обновления прогресса (сек)
+    BROADCAST_BATCH = int((os.getenv("BROADCAST_BATCH") or "100").strip())
+    BROADCAST_PROGRESS_EVERY = 3.0
+
+    # FSM в SQLite: размер горячего слоя, TTL брошенных анкет, задержка записи
+    FSM_CACHE_SIZE = int((os.getenv("FSM_CACHE_SIZE") or "10000").strip())
+    FSM_TTL_HOURS = float((os.getenv("FSM_TTL_HOURS") or "24").strip())
+    FSM_FLUSH_DELAY_MS = float((os.getenv("FSM_FLUSH_DELAY_MS") or "50").strip())
+
     # validation
     if not BOT_TOKEN:
         raise RuntimeError("❌ BOT_TOKEN не указан в Environment Variables!")
@@ -88,13 +181,409 @@ logging.basicConfig(
 logger = logging.getLogger("zary-opt-bot")
 
 
+# =========================
+# METRICS
+# =========================
+class Metrics:
+    """Минимальный реестр метрик в текстовом формате Prometheus."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.meta: Dict[str, tuple] = {}
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        self.histograms: Dict[str, Dict[tuple, list]] = {}
+        self.gauges: Dict[str, Any] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self.meta[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        # [счётчики по бакетам..., сумма, количество]
+        h = series.get(key)
+        if h is None:
+            h = series[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                h[i] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+    def gauge(self, name: str, fn):
+        """fn() -> число или {labels-tuple: число}; вызывается при отдаче /metrics."""
+        self.gauges[name] = fn
+
+    @staticmethod
+    def _labels(key: tuple, extra: tuple = ()) -> str:
+        parts = []
+        for k, v in key + extra:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{k}="{v}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def _header(self, lines: List[str], name: str, default_kind: str):
+        kind, help_text = self.meta.get(name, (default_kind, name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, series in self.counters.items():
+            self._header(lines, name, "counter")
+            for key, value in series.items():
+                lines.append(f"{name}{self._labels(key)} {value}")
+        for name, series in self.histograms.items():
+            self._header(lines, name, "histogram")
+            for key, h in series.items():
+                for bound, count in zip(self.BUCKETS, h):
+                    lines.append(f"{name}_bucket{self._labels(key, (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{self._labels(key, (('le', '+Inf'),))} {h[-1]}")
+                lines.append(f"{name}_sum{self._labels(key)} {h[-2]}")
+                lines.append(f"{name}_count{self._labels(key)} {h[-1]}")
+        for name, fn in self.gauges.items():
+            try:
+                value = fn()
+            except Exception:
+                logger.exception(f"gauge {name} failed")
+                continue
+            self._header(lines, name, "gauge")
+            if isinstance(value, dict):
+                for key, v in value.items():
+                    lines.append(f"{name}{self._labels(key)} {v}")
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_updates_total", "counter", "Updates handled per handler")
+metrics.describe("bot_handler_errors_total", "counter", "Handler exceptions per handler")
+metrics.describe("bot_handler_seconds", "histogram", "Handler latency")
+metrics.describe("db_query_seconds", "histogram", "Database method latency")
+metrics.describe("telegram_api_seconds", "histogram", "Telegram Bot API call latency")
+metrics.describe("telegram_api_errors_total", "counter", "Telegram Bot API errors")
+metrics.describe("leads_created_total", "counter", "Leads created")
+metrics.describe("scheduler_job_seconds", "histogram", "Scheduler job duration")
+metrics.describe("scheduler_job_errors_total", "counter", "Scheduler job failures")
+metrics.describe("activity_archived_total", "counter", "activity_log rows moved to the archive")
+
+
+# =========================
+# TRACING
+# =========================
+class Span:
+    __slots__ = ("kind", "name", "started", "ms", "children")
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.started = time.perf_counter()
+        self.ms = 0.0
+        self.children: List["Span"] = []
+
+    def render(self, depth: int = 0) -> List[str]:
+        lines = [f"{'  ' * depth}{self.kind} {self.name} {self.ms:.0f} ms"]
+        for child in self.children:
+            lines.extend(child.render(depth + 1))
+        return lines
+
+    def totals(self, acc: Dict[str, float]) -> Dict[str, float]:
+        for child in self.children:
+            acc[child.kind] = acc.get(child.kind, 0.0) + child.ms
+            child.totals(acc)
+        return acc
+
+
+current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+slow_traces: deque = deque(maxlen=Config.SLOW_TRACE_KEEP)
+
+
+@contextlib.contextmanager
+def trace_span(kind: str, name: str):
+    parent = current_span.get()
+    if parent is None:
+        yield
+        return
+    span = Span(kind, name)
+    parent.children.append(span)
+    token = current_span.set(span)
+    try:
+        yield
+    finally:
+        span.ms = (time.perf_counter() - span.started) * 1000
+        current_span.reset(token)
+
+
+def instrument_db(cls):
+    """Оборачивает публичные async-методы Database замером и span'ом."""
+
+    def wrap(name, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                with trace_span("db", name):
+                    return await func(*args, **kwargs)
+            finally:
+                metrics.observe("db_query_seconds", time.perf_counter() - started, method=name)
+        return wrapper
+
+    for name, func in list(vars(cls).items()):
+        if name.startswith("_") or name in ("connect", "close") or not inspect.iscoroutinefunction(func):
+            continue
+        setattr(cls, name, wrap(name, func))
+    return cls
+
+
 # =========================
 # DATABASE
 # =========================
+class LRUCache:
+    """Ограниченный LRU-кэш с TTL и счётчиками попаданий."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, expires = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+def utc_timestamp() -> str:
+    # тот же формат, что и CURRENT_TIMESTAMP в SQLite
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ActivityWriter:
+    """Write-behind буфер для activity_log: пачки через executemany в одной транзакции."""
+
+    def __init__(self, db: "Database", batch_size: int, flush_interval: float):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer: List[tuple] = []
+        self.flushed = 0
+        self.flush_count = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def add(self, user_id: int, action: str, details: str):
+        self.buffer.append((utc_timestamp(), user_id, action, details))
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("activity flush failed")
+
+    async def flush(self):
+        async with self.db.write_lock:
+            if not self.buffer:
+                return
+            batch, self.buffer = self.buffer, []
+            started = time.perf_counter()
+            conn = self.db.conn
+            assert conn is not None
+            try:
+                await conn.executemany(
+                    "INSERT INTO activity_log (timestamp, user_id, action, details) VALUES(?,?,?,?)",
+                    batch,
+                )
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                # вернуть пачку в начало буфера, попробуем в следующий раз
+                self.buffer[:0] = batch
+                raise
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+            self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+            self.flushed += len(batch)
+            self.flush_count += 1
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": len(self.buffer),
+            "flushed": self.flushed,
+            "flushes": self.flush_count,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+
+def readonly_uri(db_path: str) -> str:
+    return Path(db_path).absolute().as_uri() + "?mode=ro"
+
+
+class ReadPool:
+    """Пул read-only соединений: в WAL читатели не ждут writer и не мешают ему."""
+
+    def __init__(self, db_path: str, size: int):
+        self.db_path = db_path
+        self.size = size
+        self._idle: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+        self._all: List[aiosqlite.Connection] = []
+
+    async def open(self):
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(readonly_uri(self.db_path), uri=True)
+            conn.row_factory = aiosqlite.Row
+            await conn.execute("PRAGMA query_only = ON")
+            self._all.append(conn)
+            self._idle.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._all:
+            await conn.close()
+        self._all.clear()
+        self._idle = asyncio.Queue()
+
+
+class GroupCommitter:
+    """Group commit: конкурентные записи выполняются пачкой и фиксируются одним COMMIT."""
+
+    def __init__(self, db: "Database", window: float):
+        self.db = db
+        self.window = window
+        self.commits = 0
+        self.ops = 0
+        self._pending: List[tuple] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self, op) -> Any:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((op, fut))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+        return await fut
+
+    async def _drain(self):
+        while self._pending:
+            await asyncio.sleep(self.window)
+            async with self.db.write_lock:
+                batch, self._pending = self._pending, []
+                try:
+                    await self._commit_batch(batch)
+                except Exception as e:
+                    # сбой BEGIN/ROLLBACK: ожидающие не должны висеть вечно, а начатая
+                    # транзакция — уйти со следующим COMMIT наполовину применённой
+                    logger.exception("group commit failed")
+                    for _, fut in batch:
+                        if not fut.done():
+                            fut.set_exception(e)
+                    if self.db.conn.in_transaction:
+                        await self.db.conn.rollback()
+
+    async def _commit_batch(self, batch: List[tuple]):
+        conn = self.db.conn
+        assert conn is not None
+        results = []
+        # вся пачка — одна транзакция; без BEGIN каждый RELEASE сам бы делал COMMIT
+        if not conn.in_transaction:
+            await conn.execute("BEGIN")
+        # каждая операция в своём SAVEPOINT: ошибка одной не откатывает остальные
+        for op, fut in batch:
+            try:
+                await conn.execute("SAVEPOINT op")
+                result = await op(conn)
+                await conn.execute("RELEASE op")
+                results.append((fut, result, None))
+            except Exception as e:
+                await conn.execute("ROLLBACK TO op")
+                await conn.execute("RELEASE op")
+                results.append((fut, None, e))
+        try:
+            await conn.commit()
+        except Exception as e:
+            await conn.rollback()
+            results = [(fut, None, e) for fut, _, _ in results]
+        self.commits += 1
+        self.ops += len(batch)
+        for fut, result, err in results:
+            if fut.done():
+                continue
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(result)
+
+    def stats(self) -> Dict[str, int]:
+        return {"commits": self.commits, "ops": self.ops, "pending": len(self._pending)}
+
+
+@instrument_db
 class Database:
     def __init__(self, db_path: str):
         self.db_path = db_path
         self.conn: Optional[aiosqlite.Connection] = None
+        self.pool: Optional[ReadPool] = None
+        self.write_lock = asyncio.Lock()
+        self.writer = GroupCommitter(self, Config.GROUP_COMMIT_WINDOW_MS / 1000)
+        self.lang_cache = LRUCache(Config.LANG_CACHE_SIZE, Config.LANG_CACHE_TTL)
+        self.activity = ActivityWriter(self, Config.ACTIVITY_BATCH_SIZE, Config.ACTIVITY_FLUSH_INTERVAL)
 
     async def connect(self):
         self.conn = await aiosqlite.connect(self.db_path)
@@ -102,11 +591,33 @@ class Database:
         await self.conn.execute("PRAGMA foreign_keys = ON")
         await self.conn.execute("PRAGMA journal_mode = WAL")
         await self.init_tables()
+        await self.init_counters()
+        await self.init_search()
+        await self.warm_lang_cache()
+        if Config.DB_READ_POOL_SIZE > 0 and self.db_path != ":memory:":
+            self.pool = ReadPool(self.db_path, Config.DB_READ_POOL_SIZE)
+            await self.pool.open()
+        self.activity.start()
         logger.info("DB connected")
 
     async def close(self):
         if self.conn:
+            await self.activity.stop()
+            if self.pool is not None:
+                await self.pool.close()
+                self.pool = None
             await self.conn.close()
+            self.conn = None
+
+    @contextlib.asynccontextmanager
+    async def reader(self):
+        """Соединение для тяжёлых чтений: из пула, если он есть, иначе writer."""
+        if self.pool is None:
+            assert self.conn is not None
+            yield self.conn
+        else:
+            async with self.pool.acquire() as conn:
+                yield conn
 
     async def init_tables(self):
         assert self.conn is not None
@@ -139,6 +650,8 @@ class Database:
             CREATE INDEX IF NOT EXISTS idx_leads_user_id ON leads(user_id);
             CREATE INDEX IF NOT EXISTS idx_leads_status ON leads(status);
             CREATE INDEX IF NOT EXISTS idx_leads_created ON leads(created_at);
+            -- индексы rowid-таблицы неявно заканчиваются на id, т.е. это (city, id)
+            CREATE INDEX IF NOT EXISTS idx_leads_city ON leads(city);
 
             CREATE TABLE IF NOT EXISTS activity_log (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -148,6 +661,86 @@ class Database:
                 details TEXT
             );
 
+            -- для архивации по возрасту
+            CREATE INDEX IF NOT EXISTS idx_activity_timestamp ON activity_log(timestamp);
+
+            CREATE TABLE IF NOT EXISTS lead_notifications (
+                lead_id INTEGER NOT NULL,
+                admin_id INTEGER NOT NULL,
+                ok INTEGER NOT NULL,
+                error TEXT,
+                sent_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (lead_id, admin_id)
+            );
+
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL NOT NULL
+            );
+
+            CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm_storage(updated_at);
+
+            -- счётчики для get_stats, поддерживаются триггерами в той же транзакции
+            CREATE TABLE IF NOT EXISTS lead_counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            );
+
+            CREATE TABLE IF NOT EXISTS lead_clients (
+                user_id INTEGER PRIMARY KEY,
+                leads INTEGER NOT NULL DEFAULT 0
+            );
+
+            CREATE TRIGGER IF NOT EXISTS trg_leads_counters_ins AFTER INSERT ON leads BEGIN
+                INSERT INTO lead_counters(name, value) VALUES('total', 1)
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                INSERT INTO lead_counters(name, value) VALUES('status:' || NEW.status, 1)
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                INSERT INTO lead_counters(name, value)
+                    SELECT 'unique_users', 1
+                    WHERE NOT EXISTS (SELECT 1 FROM lead_clients WHERE user_id = NEW.user_id)
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+                INSERT INTO lead_clients(user_id, leads) VALUES(NEW.user_id, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET leads = leads + 1;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS trg_leads_counters_status AFTER UPDATE OF status ON leads
+            WHEN OLD.status IS NOT NEW.status BEGIN
+                UPDATE lead_counters SET value = value - 1 WHERE name = 'status:' || OLD.status;
+                INSERT INTO lead_counters(name, value) VALUES('status:' || NEW.status, 1)
+                    ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS trg_leads_counters_del AFTER DELETE ON leads BEGIN
+                UPDATE lead_counters SET value = value - 1 WHERE name IN ('total', 'status:' || OLD.status);
+                UPDATE lead_clients SET leads = leads - 1 WHERE user_id = OLD.user_id;
+                UPDATE lead_counters SET value = value - 1
+                    WHERE name = 'unique_users'
+                    AND EXISTS (SELECT 1 FROM lead_clients WHERE user_id = OLD.user_id AND leads <= 0);
+                DELETE FROM lead_clients WHERE user_id = OLD.user_id AND leads <= 0;
+            END;
+
+            -- рассылки: фильтр фиксируется при создании, last_user_id — checkpoint
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                finished_at TEXT,
+                admin_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                lang TEXT,
+                active_since TEXT,
+                status TEXT NOT NULL DEFAULT 'running',
+                total INTEGER NOT NULL DEFAULT 0,
+                last_user_id INTEGER NOT NULL DEFAULT 0,
+                delivered INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                progress_chat_id INTEGER,
+                progress_message_id INTEGER
+            );
+
             CREATE TABLE IF NOT EXISTS monthly_reports (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 year INTEGER NOT NULL,
@@ -157,33 +750,114 @@ class Database:
                 total_leads INTEGER NOT NULL,
                 status TEXT DEFAULT 'sent'
             );
+
+            -- докуда каждый админ уже выгрузил: последний id и последняя смена статуса
+            CREATE TABLE IF NOT EXISTS export_watermarks (
+                admin_id INTEGER PRIMARY KEY,
+                last_lead_id INTEGER NOT NULL,
+                last_status_at TEXT NOT NULL,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            );
             """
         )
+        await self.migrate()
         await self.conn.commit()
 
-    async def get_lang(self, user_id: int) -> Optional[str]:
+    async def migrate(self):
+        """Колонки, добавленные в уже существующие таблицы."""
         assert self.conn is not None
-        async with self.conn.execute("SELECT lang FROM users WHERE user_id=?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            return row[0] if row else None
+        async with self.conn.execute("PRAGMA table_info(leads)") as cur:
+            columns = {r[1] for r in await cur.fetchall()}
+        if "status_updated_at" not in columns:
+            # NULL у старых заявок: их статус не менялся с тех пор, как появилась колонка
+            await self.conn.execute("ALTER TABLE leads ADD COLUMN status_updated_at TEXT")
+            logger.info("leads.status_updated_at added")
+        await self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_leads_status_updated ON leads(status_updated_at)"
+        )
 
-    async def set_lang(self, user_id: int, lang: str):
+    async def init_search(self):
+        """FTS5-индекс по заявкам (external content: текст хранится только в leads)."""
         assert self.conn is not None
-        await self.conn.execute(
+        async with self.conn.execute("SELECT 1 FROM sqlite_master WHERE name='leads_fts'") as cur:
+            exists = await cur.fetchone() is not None
+        await self.conn.executescript(
+            """
+            -- trigram: поиск по любому фрагменту от 3 символов, в т.ч. по куску телефона
+            CREATE VIRTUAL TABLE IF NOT EXISTS leads_fts USING fts5(
+                full_name, username, city, product, phone,
+                content='leads', content_rowid='id', tokenize='trigram'
+            );
+
+            CREATE TRIGGER IF NOT EXISTS trg_leads_fts_ins AFTER INSERT ON leads BEGIN
+                INSERT INTO leads_fts(rowid, full_name, username, city, product, phone)
+                VALUES (NEW.id, NEW.full_name, NEW.username, NEW.city, NEW.product, NEW.phone);
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS trg_leads_fts_del AFTER DELETE ON leads BEGIN
+                INSERT INTO leads_fts(leads_fts, rowid, full_name, username, city, product, phone)
+                VALUES ('delete', OLD.id, OLD.full_name, OLD.username, OLD.city, OLD.product, OLD.phone);
+            END;
+
+            -- смена статуса индекс не трогает
+            CREATE TRIGGER IF NOT EXISTS trg_leads_fts_upd
+            AFTER UPDATE OF full_name, username, city, product, phone ON leads BEGIN
+                INSERT INTO leads_fts(leads_fts, rowid, full_name, username, city, product, phone)
+                VALUES ('delete', OLD.id, OLD.full_name, OLD.username, OLD.city, OLD.product, OLD.phone);
+                INSERT INTO leads_fts(rowid, full_name, username, city, product, phone)
+                VALUES (NEW.id, NEW.full_name, NEW.username, NEW.city, NEW.product, NEW.phone);
+            END;
             """
-            INSERT INTO users(user_id, lang, last_activity)
-            VALUES(?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT(user_id) DO UPDATE SET
-                lang=excluded.lang,
-                last_activity=CURRENT_TIMESTAMP
-            """,
-            (user_id, lang),
         )
+        if not exists:
+            # индекс появился в уже существующей БД
+            await self.conn.execute("INSERT INTO leads_fts(leads_fts) VALUES('rebuild')")
+            logger.info("leads_fts built")
         await self.conn.commit()
 
-    async def add_lead(self, lead: Dict[str, Any]) -> int:
+    async def warm_lang_cache(self):
         assert self.conn is not None
-        cur = await self.conn.execute(
+        async with self.conn.execute(
+            "SELECT user_id, lang FROM users ORDER BY last_activity DESC LIMIT ?",
+            (self.lang_cache.max_size,),
+        ) as cur:
+            rows = await cur.fetchall()
+        # самые активные в конце, чтобы вытеснялись последними
+        for row in reversed(rows):
+            self.lang_cache.set(row[0], row[1])
+        logger.info(f"lang cache warmed: {len(rows)} users")
+
+    async def get_lang(self, user_id: int) -> Optional[str]:
+        cached = self.lang_cache.get(user_id)
+        if cached is not None:
+            return cached
+        assert self.conn is not None
+        async with self.conn.execute("SELECT lang FROM users WHERE user_id=?", (user_id,)) as cur:
+            row = await cur.fetchone()
+        if not row:
+            return None
+        self.lang_cache.set(user_id, row[0])
+        return row[0]
+
+    async def set_lang(self, user_id: int, lang: str):
+        async def op(conn: aiosqlite.Connection):
+            await conn.execute(
+                """
+                INSERT INTO users(user_id, lang, last_activity)
+                VALUES(?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    lang=excluded.lang,
+                    last_activity=CURRENT_TIMESTAMP
+                """,
+                (user_id, lang),
+            )
+
+        await self.writer.run(op)
+        self.lang_cache.set(user_id, lang)
+
+    @staticmethod
+    async def _insert_lead(conn: aiosqlite.Connection, lead: Dict[str, Any]) -> int:
+        cur = await conn.execute(
             """
             INSERT INTO leads(created_at, user_id, username, full_name, lang,
                              role, product, qty, city, phone, status)
@@ -203,78 +877,196 @@ class Database:
                 "new",
             ),
         )
-        await self.conn.commit()
         return cur.lastrowid
 
-    async def get_last_leads(self, limit: int = 20) -> List[aiosqlite.Row]:
-        assert self.conn is not None
-        async with self.conn.execute("SELECT * FROM leads ORDER BY id DESC LIMIT ?", (limit,)) as cur:
-            return await cur.fetchall()
+    async def submit_lead(self, lead: Dict[str, Any]) -> int:
+        """Заявка и запись lead_created в одной транзакции (с group commit)."""
 
-    async def get_all_leads(self) -> List[aiosqlite.Row]:
-        assert self.conn is not None
-        async with self.conn.execute("SELECT * FROM leads ORDER BY id DESC") as cur:
-            return await cur.fetchall()
+        async def op(conn: aiosqlite.Connection) -> int:
+            lead_id = await self._insert_lead(conn, lead)
+            await conn.execute(
+                "INSERT INTO activity_log (timestamp, user_id, action, details) VALUES(?,?,?,?)",
+                (utc_timestamp(), lead["user_id"], "lead_created", f"id={lead_id}"),
+            )
+            return lead_id
+
+        return await self.writer.run(op)
+
+    async def get_leads_page(self, filters: Dict[str, str], cursor: Optional[int] = None,
+                             newer: bool = False, limit: int = 10) -> List[aiosqlite.Row]:
+        """Keyset-пагинация по id (новые сверху).
+
+        newer=False — заявки старше cursor, newer=True — новее. Возвращает до
+        limit + 1 строк, лишняя означает, что в этом направлении есть ещё.
+        """
+        where, params = [], []
+        if filters.get("status"):
+            where.append("status = ?")
+            params.append(filters["status"])
+        if filters.get("city"):
+            where.append("city = ?")
+            params.append(filters["city"])
+        # заявки пишутся в порядке created_at, поэтому период сводится к диапазону id
+        async with self.reader() as conn:
+            lo, hi = await self._date_to_id_range(conn, filters.get("from"), filters.get("to"))
+            if lo is not None:
+                where.append("id >= ?")
+                params.append(lo)
+            if hi is not None:
+                where.append("id <= ?")
+                params.append(hi)
+            if cursor is not None:
+                where.append("id > ?" if newer else "id < ?")
+                params.append(cursor)
+
+            sql = "SELECT * FROM leads"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            sql += f" ORDER BY id {'ASC' if newer else 'DESC'} LIMIT ?"
+            params.append(limit + 1)
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchall()
 
-    async def get_leads_by_date_range(self, start: str, end: str) -> List[aiosqlite.Row]:
-        assert self.conn is not None
-        async with self.conn.execute(
+    @staticmethod
+    async def _date_to_id_range(conn: aiosqlite.Connection, start: Optional[str], end: Optional[str]) -> tuple:
+        lo = hi = None
+        if start:
+            async with conn.execute(
+                "SELECT id FROM leads WHERE created_at >= ? ORDER BY created_at, id LIMIT 1", (start,)
+            ) as cur:
+                row = await cur.fetchone()
+            if row is None:
+                return 0, -1
+            lo = row[0]
+        if end:
+            async with conn.execute(
+                "SELECT id FROM leads WHERE created_at <= ? ORDER BY created_at DESC, id DESC LIMIT 1", (end,)
+            ) as cur:
+                row = await cur.fetchone()
+            if row is None:
+                return 0, -1
+            hi = row[0]
+        return lo, hi
+
+    async def search_leads(self, query: str, offset: int = 0, limit: int = 10) -> List[aiosqlite.Row]:
+        """query — готовое FTS5-выражение. До limit + 1 строк, лучшие по bm25 первыми."""
+        async with self.reader() as conn, conn.execute(
             """
-            SELECT * FROM leads
-            WHERE created_at >= ? AND created_at <= ?
-            ORDER BY id DESC
+            SELECT leads.* FROM leads_fts
+            JOIN leads ON leads.id = leads_fts.rowid
+            WHERE leads_fts MATCH ?
+            ORDER BY leads_fts.rank, leads.id DESC
+            LIMIT ? OFFSET ?
             """,
-            (start, end),
+            (query, limit + 1, offset),
         ) as cur:
             return await cur.fetchall()
 
     async def update_status(self, lead_id: int, status: str) -> bool:
-        assert self.conn is not None
-        cur = await self.conn.execute("UPDATE leads SET status=? WHERE id=?", (status, lead_id))
-        await self.conn.commit()
-        return cur.rowcount > 0
+        async def op(conn: aiosqlite.Connection) -> bool:
+            # миллисекунды: водяной знак выгрузки сравнивает строго «больше»
+            cur = await conn.execute(
+                "UPDATE leads SET status=?, status_updated_at=strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE id=?",
+                (status, lead_id),
+            )
+            return cur.rowcount > 0
 
-    async def update_notification_status(self, lead_id: int, notified: bool):
-        assert self.conn is not None
-        await self.conn.execute(
-            "UPDATE leads SET manager_notified=? WHERE id=?",
-            (1 if notified else 0, lead_id),
-        )
-        await self.conn.commit()
+        return await self.writer.run(op)
+
+    async def record_notifications(self, lead_id: int, results: List[tuple]):
+        """results: [(admin_id, ok, error)] — одна запись на весь fan-out."""
+
+        async def op(conn: aiosqlite.Connection):
+            await conn.executemany(
+                "INSERT OR REPLACE INTO lead_notifications (lead_id, admin_id, ok, error) VALUES(?,?,?,?)",
+                [(lead_id, admin_id, 1 if ok else 0, error) for admin_id, ok, error in results],
+            )
+            await conn.execute(
+                "UPDATE leads SET manager_notified=? WHERE id=?",
+                (1 if any(ok for _, ok, _ in results) else 0, lead_id),
+            )
+
+        await self.writer.run(op)
 
     async def log_activity(self, user_id: int, action: str, details: str = ""):
-        assert self.conn is not None
-        await self.conn.execute(
-            "INSERT INTO activity_log (user_id, action, details) VALUES(?,?,?)",
-            (user_id, action, details),
-        )
-        await self.conn.commit()
+        self.activity.add(user_id, action, details)
 
-    async def get_stats(self) -> Dict[str, int]:
-        assert self.conn is not None
-        async with self.conn.execute(
-            """
-            SELECT
-                COUNT(*) as total_leads,
-                SUM(CASE WHEN status='new' THEN 1 ELSE 0 END) as new_leads,
-                SUM(CASE WHEN status='work' THEN 1 ELSE 0 END) as work_leads,
-                SUM(CASE WHEN status='paid' THEN 1 ELSE 0 END) as paid_leads,
-                SUM(CASE WHEN status='shipped' THEN 1 ELSE 0 END) as shipped_leads,
-                SUM(CASE WHEN status='closed' THEN 1 ELSE 0 END) as closed_leads,
-                COUNT(DISTINCT user_id) as unique_users
-            FROM leads
+    async def get_activity_before(self, cutoff: str, limit: int) -> List[aiosqlite.Row]:
+        async with self.reader() as conn, conn.execute(
             """
+            SELECT id, timestamp, user_id, action, details FROM activity_log
+            WHERE timestamp < ? ORDER BY timestamp LIMIT ?
+            """,
+            (cutoff, limit),
         ) as cur:
-            row = await cur.fetchone()
-            return dict(row) if row else {}
+            return await cur.fetchall()
+
+    async def delete_activity(self, ids: List[int]) -> int:
+        async def op(conn: aiosqlite.Connection) -> int:
+            marks = ",".join("?" * len(ids))
+            cur = await conn.execute(f"DELETE FROM activity_log WHERE id IN ({marks})", ids)
+            return cur.rowcount
+
+        return await self.writer.run(op)
+
+    async def init_counters(self):
+        assert self.conn is not None
+        async with self.conn.execute("SELECT 1 FROM lead_counters LIMIT 1") as cur:
+            if await cur.fetchone() is None:
+                # таблица счётчиков появилась в уже существующей БД
+                await self.reconcile_stats()
+
+    async def reconcile_stats(self) -> Dict[str, int]:
+        """Пересчёт счётчиков с нуля. Возвращает расхождения со старыми значениями."""
+
+        async def op(conn: aiosqlite.Connection) -> Dict[str, int]:
+            async with conn.execute("SELECT name, value FROM lead_counters") as cur:
+                before = {r[0]: r[1] for r in await cur.fetchall()}
+            await conn.execute("DELETE FROM lead_counters")
+            await conn.execute("DELETE FROM lead_clients")
+            await conn.execute(
+                "INSERT INTO lead_clients(user_id, leads) SELECT user_id, COUNT(*) FROM leads GROUP BY user_id"
+            )
+            await conn.execute(
+                """
+                INSERT INTO lead_counters(name, value)
+                SELECT 'status:' || status, COUNT(*) FROM leads GROUP BY status
+                UNION ALL SELECT 'total', COUNT(*) FROM leads
+                UNION ALL SELECT 'unique_users', COUNT(*) FROM lead_clients
+                """
+            )
+            async with conn.execute("SELECT name, value FROM lead_counters") as cur:
+                after = {r[0]: r[1] for r in await cur.fetchall()}
+            return {
+                k: after.get(k, 0) - before.get(k, 0)
+                for k in set(before) | set(after)
+                if after.get(k, 0) != before.get(k, 0)
+            }
+
+        drift = await self.writer.run(op)
+        if drift:
+            logger.warning(f"lead counters reconciled, drift: {drift}")
+        return drift
+
+    async def get_stats(self) -> Dict[str, int]:
+        async with self.reader() as conn, conn.execute("SELECT name, value FROM lead_counters") as cur:
+            counters = {r[0]: r[1] for r in await cur.fetchall()}
+        return {
+            "total_leads": counters.get("total", 0),
+            "new_leads": counters.get("status:new", 0),
+            "work_leads": counters.get("status:work", 0),
+            "paid_leads": counters.get("status:paid", 0),
+            "shipped_leads": counters.get("status:shipped", 0),
+            "closed_leads": counters.get("status:closed", 0),
+            "unique_users": counters.get("unique_users", 0),
+        }
 
     async def get_monthly_stats(self, year: int, month: int) -> Dict[str, Any]:
         start = f"{year}-{month:02d}-01"
         last_day = monthrange(year, month)[1]
         end = f"{year}-{month:02d}-{last_day} 23:59:59"
 
-        assert self.conn is not None
-        async with self.conn.execute(
+        async with self.reader() as conn, conn.execute(
             """
             SELECT
                 COUNT(*) as total,
@@ -299,19 +1091,121 @@ class Database:
             }
 
     async def mark_report_sent(self, year: int, month: int, filename: str, total_leads: int):
-        assert self.conn is not None
-        await self.conn.execute(
-            """
-            INSERT INTO monthly_reports (year, month, sent_at, filename, total_leads)
-            VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?)
-            """,
-            (year, month, filename, total_leads),
-        )
-        await self.conn.commit()
+        async def op(conn: aiosqlite.Connection):
+            await conn.execute(
+                """
+                INSERT INTO monthly_reports (year, month, sent_at, filename, total_leads)
+                VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?)
+                """,
+                (year, month, filename, total_leads),
+            )
+
+        await self.writer.run(op)
+
+    @staticmethod
+    def _recipients_where(lang: Optional[str], active_since: Optional[str]) -> tuple:
+        where, params = [], []
+        if lang:
+            where.append("lang = ?")
+            params.append(lang)
+        if active_since:
+            where.append("last_activity >= ?")
+            params.append(active_since)
+        return where, params
+
+    async def count_recipients(self, lang: Optional[str], active_since: Optional[str]) -> int:
+        where, params = self._recipients_where(lang, active_since)
+        sql = "SELECT COUNT(*) FROM users" + (" WHERE " + " AND ".join(where) if where else "")
+        async with self.reader() as conn, conn.execute(sql, params) as cur:
+            return (await cur.fetchone())[0]
+
+    async def get_recipients(self, lang: Optional[str], active_since: Optional[str],
+                             after: int, limit: int) -> List[int]:
+        """Keyset по user_id: следующая пачка получателей после checkpoint."""
+        where, params = self._recipients_where(lang, active_since)
+        where.append("user_id > ?")
+        params += [after, limit]
+        sql = f"SELECT user_id FROM users WHERE {' AND '.join(where)} ORDER BY user_id LIMIT ?"
+        async with self.reader() as conn, conn.execute(sql, params) as cur:
+            return [r[0] for r in await cur.fetchall()]
+
+    async def create_broadcast(self, admin_id: int, text: str, lang: Optional[str],
+                               active_since: Optional[str], total: int) -> int:
+        async def op(conn: aiosqlite.Connection) -> int:
+            cur = await conn.execute(
+                "INSERT INTO broadcasts(admin_id, text, lang, active_since, total) VALUES(?,?,?,?,?)",
+                (admin_id, text, lang, active_since, total),
+            )
+            return cur.lastrowid
+
+        return await self.writer.run(op)
+
+    async def get_broadcast(self, broadcast_id: Optional[int] = None) -> Optional[aiosqlite.Row]:
+        """По id, а без id — текущая (status='running')."""
+        if broadcast_id is None:
+            sql, params = "SELECT * FROM broadcasts WHERE status='running' ORDER BY id LIMIT 1", ()
+        else:
+            sql, params = "SELECT * FROM broadcasts WHERE id=?", (broadcast_id,)
+        async with self.reader() as conn, conn.execute(sql, params) as cur:
+            return await cur.fetchone()
+
+    async def checkpoint_broadcast(self, broadcast_id: int, last_user_id: int,
+                                   delivered: int, blocked: int, failed: int):
+        async def op(conn: aiosqlite.Connection):
+            await conn.execute(
+                """
+                UPDATE broadcasts SET last_user_id=?,
+                    delivered=delivered+?, blocked=blocked+?, failed=failed+?
+                WHERE id=?
+                """,
+                (last_user_id, delivered, blocked, failed, broadcast_id),
+            )
+
+        await self.writer.run(op)
+
+    async def set_broadcast_progress_message(self, broadcast_id: int, chat_id: int, message_id: int):
+        async def op(conn: aiosqlite.Connection):
+            await conn.execute(
+                "UPDATE broadcasts SET progress_chat_id=?, progress_message_id=? WHERE id=?",
+                (chat_id, message_id, broadcast_id),
+            )
+
+        await self.writer.run(op)
+
+    async def finish_broadcast(self, broadcast_id: int, status: str):
+        async def op(conn: aiosqlite.Connection):
+            await conn.execute(
+                "UPDATE broadcasts SET status=?, finished_at=CURRENT_TIMESTAMP WHERE id=? AND status='running'",
+                (status, broadcast_id),
+            )
+
+        await self.writer.run(op)
+
+    async def get_export_watermark(self, admin_id: int) -> Optional[tuple]:
+        async with self.reader() as conn, conn.execute(
+            "SELECT last_lead_id, last_status_at FROM export_watermarks WHERE admin_id=?", (admin_id,)
+        ) as cur:
+            row = await cur.fetchone()
+        return (row[0], row[1]) if row else None
+
+    async def set_export_watermark(self, admin_id: int, mark: tuple):
+        async def op(conn: aiosqlite.Connection):
+            await conn.execute(
+                """
+                INSERT INTO export_watermarks(admin_id, last_lead_id, last_status_at, updated_at)
+                VALUES(?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(admin_id) DO UPDATE SET
+                    last_lead_id=excluded.last_lead_id,
+                    last_status_at=excluded.last_status_at,
+                    updated_at=CURRENT_TIMESTAMP
+                """,
+                (admin_id, *mark),
+            )
+
+        await self.writer.run(op)
 
     async def is_report_sent(self, year: int, month: int) -> bool:
-        assert self.conn is not None
-        async with self.conn.execute(
+        async with self.reader() as conn, conn.execute(
             "SELECT 1 FROM monthly_reports WHERE year=? AND month=? AND status='sent'",
             (year, month),
         ) as cur:
@@ -321,11 +1215,545 @@ class Database:
 db = Database(Config.DB_PATH)
 
 
+# =========================
+# FSM STORAGE
+# =========================
+class SQLiteStorage(BaseStorage):
+    """FSM в той же SQLite: горячий LRU-слой в памяти, отложенная пакетная запись, TTL."""
+
+    def __init__(self, database: Database, max_size: int, ttl: float, flush_delay: float):
+        self.db = database
+        self.max_size = max_size
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # key -> [state, data, updated_at]
+        self._hot: "OrderedDict[str, list]" = OrderedDict()
+        self._dirty: Dict[str, list] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _record(self, key: StorageKey) -> tuple:
+        k = self.key_builder.build(key)
+        rec = self._dirty.get(k) or self._hot.get(k)
+        if rec is None:
+            assert self.db.conn is not None
+            async with self.db.conn.execute(
+                "SELECT state, data, updated_at FROM fsm_storage WHERE key=?", (k,)
+            ) as cur:
+                row = await cur.fetchone()
+            if row and row[2] >= time.time() - self.ttl:
+                rec = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+            else:
+                rec = [None, {}, time.time()]
+        self._hot[k] = rec
+        self._hot.move_to_end(k)
+        # грязные записи живут в _dirty до сброса, поэтому вытеснять можно любые
+        while len(self._hot) > self.max_size:
+            self._hot.popitem(last=False)
+        return k, rec
+
+    def _touch(self, k: str, rec: list):
+        rec[2] = time.time()
+        self._dirty[k] = rec
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # все set_state/update_data одного апдейта попадают в одну запись
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("fsm flush failed")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        upserts = []
+        deletes = []
+        for k, (state, data, updated_at) in batch.items():
+            if state is None and not data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, state, json.dumps(data, ensure_ascii=False), updated_at))
+
+        async def op(conn: aiosqlite.Connection):
+            if upserts:
+                await conn.executemany(
+                    """
+                    INSERT INTO fsm_storage (key, state, data, updated_at) VALUES(?,?,?,?)
+                    ON CONFLICT(key) DO UPDATE SET
+                        state=excluded.state, data=excluded.data, updated_at=excluded.updated_at
+                    """,
+                    upserts,
+                )
+            if deletes:
+                await conn.executemany("DELETE FROM fsm_storage WHERE key=?", deletes)
+
+        try:
+            await self.db.writer.run(op)
+        except Exception:
+            for k, rec in batch.items():
+                self._dirty.setdefault(k, rec)
+            raise
+
+    async def sweep(self):
+        cutoff = time.time() - self.ttl
+        for k in [k for k, rec in self._hot.items() if rec[2] < cutoff and k not in self._dirty]:
+            del self._hot[k]
+
+        async def op(conn: aiosqlite.Connection) -> int:
+            cur = await conn.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (cutoff,))
+            return cur.rowcount
+
+        removed = await self.db.writer.run(op)
+        if removed:
+            logger.info(f"fsm sweep: {removed} abandoned states removed")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, rec = await self._record(key)
+        value = state.state if isinstance(state, State) else state
+        # state.clear() в меню не должен писать в БД, если менять нечего
+        if rec[0] != value:
+            rec[0] = value
+            self._touch(k, rec)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, rec = await self._record(key)
+        return rec[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k, rec = await self._record(key)
+        if rec[1] != data:
+            rec[1] = dict(data)
+            self._touch(k, rec)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, rec = await self._record(key)
+        return dict(rec[1])
+
+    async def close(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hot": len(self._hot), "dirty": len(self._dirty)}
+
+
 # =========================
 # BOT
 # =========================
 bot = Bot(Config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+fsm_storage = SQLiteStorage(
+    db,
+    Config.FSM_CACHE_SIZE,
+    Config.FSM_TTL_HOURS * 3600,
+    Config.FSM_FLUSH_DELAY_MS / 1000,
+)
+
+
+class ChatOrderedExecutor:
+    """Пул обработки апдейтов: разные чаты параллельно, апдейты одного чата строго по очереди.
+
+    У каждого активного чата своя очередь и своя задача-обработчик; одновременно
+    обрабатывается не больше workers чатов. Всего в очередях не больше queue_limit
+    апдейтов — дальше submit ждёт, и polling перестаёт забирать новые. В очереди
+    одного чата не больше chat_limit апдейтов — лишние отбрасываются сразу, иначе чат
+    с зависшим хендлером заполнил бы общую очередь и остановил приём для всех.
+    """
+
+    def __init__(self, workers: int, queue_limit: int, chat_limit: int):
+        self.slots = asyncio.Semaphore(max(workers, 1))
+        self.room = asyncio.Semaphore(queue_limit)
+        self.chat_limit = chat_limit
+        self.queues: Dict[int, deque] = {}
+        self.tasks: set = set()
+        self.pending = 0
+        self.dropped = 0
+
+    async def submit(self, key: Optional[int], run):
+        queue = self.queues.get(key)
+        if queue is not None and len(queue) >= self.chat_limit:
+            self.dropped += 1
+            metrics.inc("update_queue_dropped_total")
+            return
+        await self.room.acquire()
+        self.pending += 1
+        item = (run, time.perf_counter())
+        queue = self.queues.get(key)
+        if queue is not None:
+            queue.append(item)
+            return
+        self.queues[key] = deque([item])
+        task = asyncio.create_task(self._drain(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _drain(self, key: Optional[int]):
+        queue = self.queues[key]
+        try:
+            while queue:
+                run, queued = queue.popleft()
+                try:
+                    async with self.slots:
+                        metrics.observe("update_queue_wait_seconds", time.perf_counter() - queued)
+                        await run()
+                except Exception:
+                    logger.exception(f"update processing failed (chat {key})")
+                finally:
+                    self.pending -= 1
+                    self.room.release()
+        finally:
+            del self.queues[key]
+
+    async def join(self, timeout: float):
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+
+
+def update_chat_key(update: Update) -> Optional[int]:
+    context = UserContextMiddleware.resolve_event_context(update)
+    if context.chat is not None:
+        return context.chat.id
+    return context.user.id if context.user is not None else None
+
+
+class OrderedDispatcher(Dispatcher):
+    """feed_update ставит апдейт в очередь его чата.
+
+    Очередь стоит до всех middleware (в т.ч. FSM): состояние читается, только
+    когда предыдущий апдейт этого чата уже обработан.
+    """
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        if Config.UPDATE_WORKERS <= 0:
+            return await super().feed_update(bot, update, **kwargs)
+        run = functools.partial(super().feed_update, bot, update, **kwargs)
+        await update_executor.submit(update_chat_key(update), run)
+        return None
+
+
+update_executor = ChatOrderedExecutor(
+    Config.UPDATE_WORKERS, Config.UPDATE_QUEUE_LIMIT, Config.UPDATE_CHAT_QUEUE_LIMIT
+)
+dp = OrderedDispatcher(storage=fsm_storage)
+
+
+# =========================
+# OUTBOUND
+# =========================
+# приоритеты исходящих: ответы пользователям, уведомления админам, массовые отправки
+LANE_USER, LANE_ADMIN, LANE_BULK = 0, 1, 2
+send_lane: contextvars.ContextVar[int] = contextvars.ContextVar("send_lane", default=LANE_USER)
+
+
+@contextlib.contextmanager
+def send_priority(lane: int):
+    """Все отправки внутри блока (и в созданных в нём задачах) идут в очередь lane."""
+    token = send_lane.set(lane)
+    try:
+        yield
+    finally:
+        send_lane.reset(token)
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Темп исходящих под лимиты Telegram и повтор после retry_after / сбоев сети.
+
+    Лимитируются только методы с chat_id (отправка и редактирование сообщений).
+    Сначала ждём очередь своего чата (GCRA: слот резервируется сразу, порядок
+    сообщений в чате сохраняется), затем общий token bucket. Общие токены
+    раздаются по приоритету lane, внутри lane — по очереди.
+    """
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: int, group_rate: float, max_retries: int):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.tokens = rate
+        self.refilled = time.monotonic()
+        self.paused_until = 0.0
+        self.chat_tat: Dict[int, float] = {}
+        self.waiters: List[tuple] = []
+        self._seq = 0
+        self._pump: Optional[asyncio.Task] = None
+
+    # --- per-chat ---
+    def _reserve_chat(self, chat_id: int) -> float:
+        """Резервирует слот чата, возвращает сколько ждать."""
+        now = time.monotonic()
+        interval = 1 / (self.group_rate if chat_id < 0 else self.chat_rate)
+        tat = max(self.chat_tat.get(chat_id, now), now)
+        wait = max(0.0, tat - now - interval * (self.chat_burst - 1))
+        self.chat_tat[chat_id] = tat + interval
+        if len(self.chat_tat) > 10000:
+            # чаты с прошедшим tat ничем не отличаются от новых
+            self.chat_tat = {k: v for k, v in self.chat_tat.items() if v > now}
+        return wait
+
+    # --- global ---
+    def _refill(self, now: float):
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    async def _acquire_global(self, lane: int):
+        now = time.monotonic()
+        self._refill(now)
+        if not self.waiters and now >= self.paused_until and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self.waiters, (lane, self._seq, fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run_pump())
+        await fut
+
+    async def _run_pump(self):
+        while self.waiters:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, fut = heapq.heappop(self.waiters)
+            if not fut.done():
+                self.tokens -= 1
+                fut.set_result(None)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if self.rate <= 0 or not isinstance(chat_id, int):
+            return await make_request(bot, method)
+
+        lane = send_lane.get()
+        started = time.perf_counter()
+        with trace_span("queue", type(method).__name__):
+            wait = self._reserve_chat(chat_id)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._acquire_global(lane)
+        metrics.observe("outbound_wait_seconds", time.perf_counter() - started, lane=str(lane))
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                metrics.inc("outbound_retries_total", reason="retry_after")
+                logger.warning(f"{type(method).__name__} to {chat_id}: flood control, retry in {e.retry_after}s")
+                # 429 — признак, что упёрлись в лимит: притормаживаем всю очередь
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except (TelegramServerError, TelegramNetworkError) as e:
+                if attempt == self.max_retries:
+                    raise
+                metrics.inc("outbound_retries_total", reason=type(e).__name__)
+                await asyncio.sleep(0.5 * 2 ** attempt)
+            await self._acquire_global(lane)
+
+
+outbound = OutboundLimiter(
+    Config.SEND_RATE, Config.SEND_CHAT_RATE, Config.SEND_CHAT_BURST,
+    Config.SEND_GROUP_RATE, Config.SEND_MAX_RETRIES,
+)
+# первым: ожидание в очереди не попадает в telegram_api_seconds, каждый повтор — отдельный вызов
+bot.session.middleware(outbound)
+
+
+# =========================
+# INSTRUMENTATION
+# =========================
+def handler_name(data: Dict[str, Any]) -> str:
+    button = data.get("button")
+    if button:
+        return buttons.actions[button[0]].__name__
+    handler = data.get("handler")
+    return handler.callback.__name__ if handler is not None else "unknown"
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Корневой span на апдейт; медленные апдейты логируются с разбивкой."""
+
+    async def __call__(self, handler, event, data):
+        root = Span("update", f"{event.update_id} ({event.event_type})")
+        token = current_span.set(root)
+        try:
+            return await handler(event, data)
+        finally:
+            current_span.reset(token)
+            root.ms = (time.perf_counter() - root.started) * 1000
+            if root.ms >= Config.SLOW_UPDATE_MS:
+                record_slow_trace(root)
+
+
+def record_slow_trace(root: Span):
+    totals = root.totals({})
+    summary = ", ".join(f"{k}={v:.0f}ms" for k, v in totals.items())
+    slow_traces.append((datetime.now(), root))
+    logger.warning(f"slow update {root.name}: {root.ms:.0f} ms [{summary}]\n" + "\n".join(root.render()))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            with trace_span("handler", handler_name(data)):
+                return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=handler_name(data))
+            raise
+        finally:
+            name = handler_name(data)
+            metrics.inc("bot_updates_total", handler=name)
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            with trace_span("api", name):
+                return await make_request(bot, method)
+        except TelegramAPIError as e:
+            metrics.inc("telegram_api_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("telegram_api_seconds", time.perf_counter() - started, method=name)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Token bucket на user_id. Лишние апдейты отбрасываются до фильтров и хендлеров.
+
+    Шаги анкеты (Form) не отбрасываются никогда. На отброшенное пользователь получает
+    одно «подождите» за всплеск, нажатие inline-кнопки всегда получает ответ.
+
+    Корзина — (токены, время) в OrderedDict по давности обращения. Корзина, простоявшая
+    burst / rate секунд, снова полная и ничем не отличается от отсутствующей, поэтому
+    такие вытесняются с начала словаря по ходу работы.
+    """
+
+    def __init__(self, rate: float, burst: float, max_users: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        # rate <= 0 — ограничение выключено
+        self.refill_time = burst / rate if rate > 0 else 0.0
+        self.buckets: "OrderedDict[int, tuple]" = OrderedDict()
+        # кому уже ответили «подождите» в текущем всплеске
+        self.warned: set = set()
+        self.dropped = 0
+
+    def allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        buckets = self.buckets
+        while buckets:
+            oldest, (_, last) = next(iter(buckets.items()))
+            if now - last < self.refill_time and len(buckets) < self.max_users:
+                break
+            del buckets[oldest]
+            self.warned.discard(oldest)
+
+        item = buckets.pop(user_id, None)
+        if item is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, item[0] + (now - item[1]) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        buckets[user_id] = (tokens, now)
+        return allowed
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if self.rate <= 0 or user is None or is_admin(user.id):
+            return await handler(event, data)
+        if self.allow(user.id):
+            self.warned.discard(user.id)
+            return await handler(event, data)
+        # шаги анкеты не отбрасываем: иначе заявка молча теряется на середине
+        if data.get("raw_state") in Form.__all_states_names__:
+            return await handler(event, data)
+        self.dropped += 1
+        metrics.inc("throttled_updates_total", event=type(event).__name__)
+
+        # одно «подождите» на всплеск, а не по ответу на каждый лишний апдейт
+        text = None
+        if user.id not in self.warned:
+            self.warned.add(user.id)
+            text = t("slow_down", await get_user_lang(user.id, user.language_code))
+        with contextlib.suppress(TelegramAPIError):
+            if isinstance(event, CallbackQuery):
+                # без ответа у кнопки так и крутится индикатор загрузки
+                await event.answer(text)
+            elif text and isinstance(event, Message):
+                await event.answer(text)
+        return None
+
+
+def timed_job(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            metrics.inc("scheduler_job_errors_total", job=func.__name__)
+            raise
+        finally:
+            metrics.observe("scheduler_job_seconds", time.perf_counter() - started, job=func.__name__)
+    return wrapper
+
+
+dp.update.outer_middleware(TracingMiddleware())
+throttling = ThrottlingMiddleware(Config.THROTTLE_RATE, Config.THROTTLE_BURST, Config.THROTTLE_MAX_USERS)
+# один экземпляр: сообщения и нажатия кнопок тратят общие токены
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(ApiMetricsMiddleware())
+
+metrics.describe("lang_cache_hits_total", "counter", "Language cache hits")
+metrics.describe("lang_cache_misses_total", "counter", "Language cache misses")
+metrics.describe("activity_queue_depth", "gauge", "Buffered activity_log rows")
+metrics.describe("activity_flush_last_seconds", "gauge", "Duration of the last activity_log flush")
+metrics.describe("group_commit_commits_total", "counter", "Group commits")
+metrics.describe("group_commit_ops_total", "counter", "Write operations committed by group commit")
+metrics.describe("fsm_hot_states", "gauge", "FSM records in the hot layer")
+metrics.describe("db_read_pool_idle", "gauge", "Idle read-only connections")
+metrics.describe("throttled_updates_total", "counter", "Updates dropped by per-user throttling")
+metrics.describe("throttle_buckets", "gauge", "Users with a partially spent token bucket")
+metrics.describe("outbound_wait_seconds", "histogram", "Time an outgoing message waited for the rate limiter")
+metrics.describe("outbound_retries_total", "counter", "Outgoing requests retried after flood control or network errors")
+metrics.describe("outbound_queue_depth", "gauge", "Outgoing messages waiting for a global token")
+metrics.describe("broadcast_messages_total", "counter", "Broadcast messages by outcome")
+metrics.describe("update_queue_wait_seconds", "histogram", "Time an update waited in its chat queue")
+metrics.describe("update_queue_depth", "gauge", "Updates queued or in progress")
+metrics.describe("update_queue_dropped_total", "counter", "Updates dropped over the per-chat queue limit")
+metrics.describe("update_active_chats", "gauge", "Chats with queued updates")
+metrics.gauge("lang_cache_hits_total", lambda: db.lang_cache.hits)
+metrics.gauge("lang_cache_misses_total", lambda: db.lang_cache.misses)
+metrics.gauge("activity_queue_depth", lambda: len(db.activity.buffer))
+metrics.gauge("activity_flush_last_seconds", lambda: db.activity.last_flush_ms / 1000)
+metrics.gauge("group_commit_commits_total", lambda: db.writer.commits)
+metrics.gauge("group_commit_ops_total", lambda: db.writer.ops)
+metrics.gauge("fsm_hot_states", lambda: len(fsm_storage._hot))
+metrics.gauge("db_read_pool_idle", lambda: db.pool._idle.qsize() if db.pool else 0)
+metrics.gauge("throttle_buckets", lambda: len(throttling.buckets))
+metrics.gauge("outbound_queue_depth", lambda: len(outbound.waiters))
+metrics.gauge("update_queue_depth", lambda: update_executor.pending)
+metrics.gauge("update_active_chats", lambda: len(update_executor.queues))
 
 
 # =========================
@@ -385,14 +1813,28 @@ TEXT = {
         "admin_only": "⛔ Только для администратора.",
         "admin_menu": "🛠 <b>Панель управления</b>",
         "admin_empty": "📝 Пока нет заявок.",
-        "admin_export_ok": "✅ Excel сформирован.",
-        "admin_export_fail": "❌ Ошибка при создании Excel.",
+        "admin_export_ok": "✅ Выгрузка готова.",
+        "admin_export_fail": "❌ Ошибка при создании выгрузки.",
+        "export_choose": "📤 Выберите формат выгрузки:\n🆕 — только новые и сменившие статус с вашей прошлой выгрузки",
+        "export_no_changes": "🆕 С прошлой выгрузки ничего нового.",
+        "export_too_big": "❌ Файл больше 50 MB — выберите CSV.gz.",
         "admin_status_bad": (
             "❌ Неверная команда.\n\n"
             "Используйте: /status ID статус\n"
             "Статусы: new, work, paid, shipped, closed"
         ),
         "admin_status_updated": "✅ Статус обновлён.",
+        "leads_title": "📋 <b>Заявки</b>",
+        "leads_usage": (
+            "Используйте: /leads [статус] [city=Город] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]\n"
+            "Статусы: new, work, paid, shipped, closed"
+        ),
+        "leads_newer": "⬅️ Новее",
+        "leads_older": "Старее ➡️",
+        "find_usage": "Используйте: /find текст (имя, @username, город, товар или часть телефона, от 3 символов)",
+        "find_title": "🔎 <b>Поиск:</b>",
+        "find_empty": "🔎 Ничего не найдено.",
+        "slow_down": "⏳ Слишком часто. Подождите пару секунд и повторите.",
         "error": "⚠️ Ошибка. Попробуйте позже.",
     },
     "uz": {
@@ -448,14 +1890,28 @@ TEXT = {
         "admin_only": "⛔ Faqat admin uchun.",
         "admin_menu": "🛠 <b>Admin panel</b>",
         "admin_empty": "📝 Hozircha arizalar yo'q.",
-        "admin_export_ok": "✅ Excel tayyor.",
-        "admin_export_fail": "❌ Excel yaratishda xatolik.",
+        "admin_export_ok": "✅ Eksport tayyor.",
+        "admin_export_fail": "❌ Eksport yaratishda xatolik.",
+        "export_choose": "📤 Eksport formatini tanlang:\n🆕 — oxirgi eksportingizdan keyin yangi va holati o'zgarganlar",
+        "export_no_changes": "🆕 Oxirgi eksportdan beri yangilik yo'q.",
+        "export_too_big": "❌ Fayl 50 MB dan katta — CSV.gz ni tanlang.",
         "admin_status_bad": (
             "❌ Noto'g'ri buyruq.\n\n"
             "/status ID status\n"
             "Status: new, work, paid, shipped, closed"
         ),
         "admin_status_updated": "✅ Status yangilandi.",
+        "leads_title": "📋 <b>Arizalar</b>",
+        "leads_usage": (
+            "/leads [status] [city=Shahar] [from=YYYY-MM-DD] [to=YYYY-MM-DD]\n"
+            "Status: new, work, paid, shipped, closed"
+        ),
+        "leads_newer": "⬅️ Yangiroq",
+        "leads_older": "Eskiroq ➡️",
+        "find_usage": "/find matn (ism, @username, shahar, mahsulot yoki telefon qismi, kamida 3 belgi)",
+        "find_title": "🔎 <b>Qidiruv:</b>",
+        "find_empty": "🔎 Hech narsa topilmadi.",
+        "slow_down": "⏳ Juda tez. Bir necha soniya kutib, qaytadan yuboring.",
         "error": "⚠️ Xatolik. Keyinroq urinib ko'ring.",
     },
 }
@@ -475,6 +1931,10 @@ BTN = {
         "cancel": "❌ Отмена",
         "contact": "📲 Отправить контакт",
         "back": "⬅️ Назад",
+        "last": "📋 Последние",
+        "stats": "📊 Статистика",
+        "export": "📤 Экспорт",
+        "status": "ℹ️ Status",
     },
     "uz": {
         "catalog": "📦 Katalog",
@@ -489,10 +1949,20 @@ BTN = {
         "cancel": "❌ Bekor qilish",
         "contact": "📲 Kontakt yuborish",
         "back": "⬅️ Orqaga",
+        "last": "📋 Oxirgi",
+        "stats": "📊 Statistika",
+        "export": "📤 Eksport",
+        "status": "ℹ️ Status",
     },
 }
 
 
+LANG_BUTTONS = {"ru": "🇷🇺 Русский", "uz": "🇺🇿 O'zbekcha"}
+
+# старые подписи кнопок: у пользователей могут остаться клавиатуры прежних версий
+LEGACY_BUTTONS = {"📤 Excel": "export"}
+
+
 def t(key: str, lang: str, **kwargs) -> str:
     lang = lang if lang in TEXT else "ru"
     base = TEXT[lang].get(key, key)
@@ -558,7 +2028,7 @@ class Keyboards:
     @staticmethod
     def lang() -> ReplyKeyboardMarkup:
         return ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text="🇷🇺 Русский"), KeyboardButton(text="🇺🇿 O'zbekcha")]],
+            keyboard=[[KeyboardButton(text=LANG_BUTTONS["ru"]), KeyboardButton(text=LANG_BUTTONS["uz"])]],
             resize_keyboard=True,
             one_time_keyboard=True,
         )
@@ -638,15 +2108,97 @@ class Keyboards:
         b = BTN[lang]
         return ReplyKeyboardMarkup(
             keyboard=[
-                [KeyboardButton(text="📋 Последние" if lang == "ru" else "📋 Oxirgi"),
-                 KeyboardButton(text="📊 Статистика" if lang == "ru" else "📊 Statistika")],
-                [KeyboardButton(text="📤 Excel"), KeyboardButton(text="ℹ️ Status")],
+                [KeyboardButton(text=b["last"]), KeyboardButton(text=b["stats"])],
+                [KeyboardButton(text=b["export"]), KeyboardButton(text=b["status"])],
                 [KeyboardButton(text=b["back"])],
             ],
             resize_keyboard=True,
         )
 
 
+class Screens:
+    """Готовые (text, markup) статичных экранов для каждой пары (lang, admin).
+
+    Зависят только от TEXT/BTN, поэтому собираются один раз; после изменения
+    TEXT/BTN нужно вызвать Screens.rebuild() и buttons.rebuild().
+    """
+
+    STATIC = ("menu", "manager", "channel", "catalog", "terms", "why", "min_order", "cancelled")
+
+    _cache: Dict[tuple, tuple] = {}
+
+    @classmethod
+    def rebuild(cls):
+        cache = {}
+        for lang in TEXT:
+            for admin in (False, True):
+                markup = Keyboards.main(lang, admin)
+                for key in cls.STATIC:
+                    cache[(key, lang, admin)] = (t(key, lang), markup)
+        cls._cache = cache
+
+    @classmethod
+    def get(cls, key: str, lang: str, admin: bool) -> tuple:
+        item = cls._cache.get((key, lang, admin))
+        if item is None:
+            item = (t(key, lang), Keyboards.main(lang if lang in BTN else "ru", admin))
+            cls._cache[(key, lang, admin)] = item
+        return item
+
+    @classmethod
+    def main_keyboard(cls, lang: str, admin: bool) -> ReplyKeyboardMarkup:
+        return cls.get("menu", lang, admin)[1]
+
+
+Screens.rebuild()
+
+
+class ButtonRouter:
+    """Маршрутизация кнопок одним поиском в словаре: текст -> (action, lang).
+
+    Язык берётся из самой кнопки, поэтому БД не нужна. Для кнопок с одинаковым
+    текстом в обоих языках lang = None, и язык определяется через get_user_lang.
+    """
+
+    def __init__(self):
+        self.actions: Dict[str, Any] = {}
+        self.index: Dict[str, tuple] = {}
+
+    def action(self, name: str):
+        def decorator(func):
+            self.actions[name] = func
+            return func
+        return decorator
+
+    def rebuild(self):
+        index: Dict[str, tuple] = {}
+        sources = [(lang, {"set_lang": text}) for lang, text in LANG_BUTTONS.items()]
+        sources += list(BTN.items())
+        for lang, labels in sources:
+            for action, text in labels.items():
+                if action not in self.actions:
+                    continue
+                prev = index.get(text)
+                index[text] = (action, lang if prev is None or prev[1] == lang else None)
+        for text, action in LEGACY_BUTTONS.items():
+            if action in self.actions:
+                index.setdefault(text, (action, None))
+        self.index = index
+
+    def __call__(self, message: Message) -> Any:
+        hit = self.index.get(message.text) if message.text else None
+        return {"button": hit} if hit else False
+
+    async def dispatch(self, message: Message, state: FSMContext, button: tuple):
+        action, lang = button
+        if lang is None:
+            lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
+        await self.actions[action](message, state, lang)
+
+
+buttons = ButtonRouter()
+
+
 # =========================
 # HANDLERS
 # =========================
@@ -656,83 +2208,83 @@ async def cmd_start(message: Message, state: FSMContext):
     lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
     await db.log_activity(message.from_user.id, "start", f"lang={lang}")
     await message.answer(t("welcome", lang))
-    await message.answer(t("menu", lang), reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    text, markup = Screens.get("menu", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
 
 
-@dp.message(F.text.in_(["🇷🇺 Русский", "🇺🇿 O'zbekcha"]))
-async def set_lang(message: Message, state: FSMContext):
+dp.message.register(buttons.dispatch, buttons)
+
+
+@buttons.action("set_lang")
+async def set_lang(message: Message, state: FSMContext, lang: str):
     await state.clear()
-    lang = "ru" if "Русский" in (message.text or "") else "uz"
     await db.set_lang(message.from_user.id, lang)
     await db.log_activity(message.from_user.id, "set_lang", lang)
     await message.answer(t("welcome", lang))
-    await message.answer(t("menu", lang), reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    text, markup = Screens.get("menu", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
 
 
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["lang"], BTN["uz"]["lang"]})
-async def change_lang(message: Message, state: FSMContext):
+@buttons.action("lang")
+async def change_lang(message: Message, state: FSMContext, lang: str):
     await state.clear()
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
     await message.answer(t("choose_lang", lang), reply_markup=Keyboards.lang())
 
 
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["manager"], BTN["uz"]["manager"]})
-async def menu_manager(message: Message, state: FSMContext):
+@buttons.action("manager")
+async def menu_manager(message: Message, state: FSMContext, lang: str):
     await state.clear()
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
-    await message.answer(t("manager", lang), reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    text, markup = Screens.get("manager", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
 
 
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["channel"], BTN["uz"]["channel"]})
-async def menu_channel(message: Message, state: FSMContext):
+@buttons.action("channel")
+async def menu_channel(message: Message, state: FSMContext, lang: str):
     await state.clear()
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
-    await message.answer(t("channel", lang), reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    text, markup = Screens.get("channel", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
 
 
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["catalog"], BTN["uz"]["catalog"]})
-async def menu_catalog(message: Message, state: FSMContext):
+@buttons.action("catalog")
+async def menu_catalog(message: Message, state: FSMContext, lang: str):
     await state.clear()
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
-    await message.answer(t("catalog", lang), reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    text, markup = Screens.get("catalog", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
 
 
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["terms"], BTN["uz"]["terms"]})
-async def menu_terms(message: Message, state: FSMContext):
+@buttons.action("terms")
+async def menu_terms(message: Message, state: FSMContext, lang: str):
     await state.clear()
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
-    await message.answer(t("terms", lang), reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    text, markup = Screens.get("terms", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
 
 
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["why"], BTN["uz"]["why"]})
-async def menu_why(message: Message, state: FSMContext):
+@buttons.action("why")
+async def menu_why(message: Message, state: FSMContext, lang: str):
     await state.clear()
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
-    await message.answer(t("why", lang), reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    text, markup = Screens.get("why", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
 
 
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["min"], BTN["uz"]["min"]})
-async def menu_min(message: Message, state: FSMContext):
+@buttons.action("min")
+async def menu_min(message: Message, state: FSMContext, lang: str):
     await state.clear()
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
-    await message.answer(t("min_order", lang), reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    text, markup = Screens.get("min_order", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
 
 
 # ---- FORM ----
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["leave"], BTN["uz"]["leave"]})
-async def form_start(message: Message, state: FSMContext):
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
+@buttons.action("leave")
+async def form_start(message: Message, state: FSMContext, lang: str):
     await state.set_state(Form.role)
     await message.answer(t("form_role", lang), reply_markup=Keyboards.form_role(lang))
 
 
 @dp.message(Form.role)
 async def form_role(message: Message, state: FSMContext):
+    # «Отмена» перехватывает ButtonRouter раньше FSM-хендлеров
     lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
     text = (message.text or "").strip()
-    if text in {BTN["ru"]["cancel"], BTN["uz"]["cancel"]}:
-        await cancel_handler(message, state)
-        return
     await state.update_data(role=text)
     await state.set_state(Form.product)
     await message.answer(t("form_product", lang), reply_markup=Keyboards.form_product(lang))
@@ -742,9 +2294,6 @@ async def form_role(message: Message, state: FSMContext):
 async def form_product(message: Message, state: FSMContext):
     lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
     text = (message.text or "").strip()
-    if text in {BTN["ru"]["cancel"], BTN["uz"]["cancel"]}:
-        await cancel_handler(message, state)
-        return
     await state.update_data(product=text)
     await state.set_state(Form.qty)
     await message.answer(t("form_qty", lang), reply_markup=Keyboards.form_qty(lang))
@@ -754,9 +2303,6 @@ async def form_product(message: Message, state: FSMContext):
 async def form_qty(message: Message, state: FSMContext):
     lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
     text = (message.text or "").strip()
-    if text in {BTN["ru"]["cancel"], BTN["uz"]["cancel"]}:
-        await cancel_handler(message, state)
-        return
     await state.update_data(qty=text)
     await state.set_state(Form.city)
     await message.answer(t("form_city", lang), reply_markup=ReplyKeyboardMarkup(
@@ -769,9 +2315,6 @@ async def form_qty(message: Message, state: FSMContext):
 async def form_city(message: Message, state: FSMContext):
     lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
     text = (message.text or "").strip()
-    if text in {BTN["ru"]["cancel"], BTN["uz"]["cancel"]}:
-        await cancel_handler(message, state)
-        return
     await state.update_data(city=text)
     await state.set_state(Form.phone)
     await message.answer(t("form_phone", lang), reply_markup=Keyboards.form_phone(lang))
@@ -781,10 +2324,6 @@ async def form_city(message: Message, state: FSMContext):
 async def form_phone(message: Message, state: FSMContext):
     lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
 
-    if (message.text or "").strip() in {BTN["ru"]["cancel"], BTN["uz"]["cancel"]}:
-        await cancel_handler(message, state)
-        return
-
     raw = message.contact.phone_number if message.contact else (message.text or "").strip()
     phone = normalize_phone(raw)
 
@@ -809,11 +2348,11 @@ async def form_phone(message: Message, state: FSMContext):
     }
 
     try:
-        lead_id = await db.add_lead(lead)
-        await db.log_activity(user.id, "lead_created", f"id={lead_id}")
+        lead_id = await db.submit_lead(lead)
+        metrics.inc("leads_created_total", lang=lang)
         await notify_admins(lead, lead_id, lang)
         await message.answer(t("thanks", lang, lead_id=lead_id),
-                             reply_markup=Keyboards.main(lang, is_admin(user.id)))
+                             reply_markup=Screens.main_keyboard(lang, is_admin(user.id)))
     except Exception as e:
         logger.exception("save lead failed")
         await message.answer(t("error", lang))
@@ -835,70 +2374,219 @@ async def notify_admins(lead: dict, lead_id: int, client_lang: str):
         f"📋 /status {lead_id} work"
     )
 
-    for admin_id in Config.ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, msg)
-            await db.update_notification_status(lead_id, True)
-        except TelegramAPIError as e:
-            logger.error(f"notify admin failed: {e}")
-            await db.log_activity(lead["user_id"], "notify_failed", str(e))
+    started = time.perf_counter()
+    with send_priority(LANE_ADMIN):
+        results = await asyncio.gather(*(send_to_admin(admin_id, msg) for admin_id in Config.ADMIN_IDS))
+    elapsed_ms = (time.perf_counter() - started) * 1000
 
+    for _, ok, error in results:
+        if not ok:
+            await db.log_activity(lead["user_id"], "notify_failed", error or "")
+    await db.record_notifications(lead_id, results)
 
-async def cancel_handler(message: Message, state: FSMContext):
-    await state.clear()
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
-    await message.answer(t("cancelled", lang),
-                         reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    delivered = sum(1 for _, ok, _ in results if ok)
+    logger.info(f"lead #{lead_id} fan-out: {delivered}/{len(results)} admins in {elapsed_ms:.0f} ms")
+
+
+async def send_to_admin(admin_id: int, text: str) -> tuple:
+    # темп и повторы после retry_after — в OutboundLimiter
+    try:
+        await bot.send_message(admin_id, text)
+        return admin_id, True, None
+    except TelegramAPIError as e:
+        logger.error(f"notify admin {admin_id} failed: {e}")
+        return admin_id, False, str(e)
 
 
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["cancel"], BTN["uz"]["cancel"]})
-async def cmd_cancel(message: Message, state: FSMContext):
-    await cancel_handler(message, state)
+@buttons.action("cancel")
+async def cmd_cancel(message: Message, state: FSMContext, lang: str):
+    await state.clear()
+    text, markup = Screens.get("cancelled", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
 
 
 # =========================
 # ADMIN
 # =========================
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["admin"], BTN["uz"]["admin"]})
-async def admin_menu(message: Message, state: FSMContext):
+@buttons.action("admin")
+async def admin_menu(message: Message, state: FSMContext, lang: str):
     await state.clear()
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
     if not is_admin(message.from_user.id):
         await message.answer(t("admin_only", lang))
         return
     await message.answer(t("admin_menu", lang), reply_markup=Keyboards.admin(lang))
 
 
-@dp.message(lambda m: (m.text or "").startswith("📋"))
-async def admin_last(message: Message, state: FSMContext):
+STATUSES = ("new", "work", "paid", "shipped", "closed")
+STATUS_EMOJI = {"new": "🆕", "work": "🔧", "paid": "💰", "shipped": "🚚", "closed": "✅"}
+TELEGRAM_TEXT_LIMIT = 4096
+
+# фильтры браузера заявок по админам (админов единицы, держим в памяти)
+lead_filters: Dict[int, Dict[str, str]] = {}
+
+
+class LeadsPage(CallbackData, prefix="lp"):
+    cursor: int
+    newer: bool
+
+
+# последний /find по админам: (что ввёл админ, FTS5-выражение)
+find_queries: Dict[int, tuple] = {}
+
+
+class FindPage(CallbackData, prefix="fp"):
+    offset: int
+
+
+def format_lead(r) -> str:
+    # роль, товар, город и телефон вводит пользователь: один «<» сломал бы всю страницу
+    role, product, city, phone = (html.escape(str(r[k] or "")) for k in ("role", "product", "city", "phone"))
+    return (
+        f"<b>#{r['id']}</b> {STATUS_EMOJI.get(r['status'], '❓')} <code>{r['status']}</code>\n"
+        f"📅 {str(r['created_at'])[:16]} | {role} | {product}\n"
+        f"📍 {city} | ☎️ {phone}\n"
+        f"{'✓' if r['manager_notified'] else '✗'} | {r['user_id']}\n"
+        f"──────────────"
+    )
+
+
+def split_message(parts: List[str], limit: int = TELEGRAM_TEXT_LIMIT) -> List[str]:
+    chunks: List[str] = []
+    current = ""
+    for part in parts:
+        while len(part) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(part[:limit])
+            part = part[limit:]
+        candidate = f"{current}\n{part}" if current else part
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = part
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def parse_lead_filters(args: str) -> Optional[Dict[str, str]]:
+    filters: Dict[str, str] = {}
+    for token in args.split():
+        if token.lower() in STATUSES:
+            filters["status"] = token.lower()
+            continue
+        key, sep, value = token.partition("=")
+        key = key.lower()
+        if not sep or not value:
+            return None
+        if key == "city":
+            filters["city"] = value
+        elif key in ("from", "to"):
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return None
+            filters[key] = value if key == "from" else f"{value} 23:59:59"
+        else:
+            return None
+    return filters
+
+
+async def render_leads_page(admin_id: int, lang: str, cursor: Optional[int] = None,
+                            newer: bool = False) -> tuple:
+    filters = lead_filters.get(admin_id, {})
+    size = Config.LEADS_PAGE_SIZE
+    rows = await db.get_leads_page(filters, cursor, newer, size)
+    has_more = len(rows) > size
+    rows = list(rows[:size])
+    if newer:
+        rows.reverse()
+    if not rows:
+        return [], None
+
+    has_newer = has_more if newer else cursor is not None
+    has_older = True if newer else has_more
+
+    header = t("leads_title", lang)
+    if filters:
+        header += "\n🔎 " + " ".join(f"{k}={html.escape(v[:10])}" for k, v in filters.items())
+    chunks = split_message([header + "\n"] + [format_lead(r) for r in rows])
+
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(
+            text=t("leads_newer", lang),
+            callback_data=LeadsPage(cursor=rows[0]["id"], newer=True).pack(),
+        ))
+    if has_older:
+        nav.append(InlineKeyboardButton(
+            text=t("leads_older", lang),
+            callback_data=LeadsPage(cursor=rows[-1]["id"], newer=False).pack(),
+        ))
+    markup = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return chunks, markup
+
+
+async def send_leads_page(message: Message, lang: str):
+    chunks, markup = await render_leads_page(message.from_user.id, lang)
+    if not chunks:
+        await message.answer(t("admin_empty", lang), reply_markup=Keyboards.admin(lang))
+        return
+    for i, chunk in enumerate(chunks):
+        await message.answer(chunk, reply_markup=markup if i == len(chunks) - 1 else None)
+
+
+@buttons.action("last")
+async def admin_last(message: Message, state: FSMContext, lang: str):
+    await state.clear()
+    if not is_admin(message.from_user.id):
+        return
+    lead_filters.pop(message.from_user.id, None)
+    await send_leads_page(message, lang)
+
+
+@dp.message(Command("leads"))
+async def admin_leads(message: Message, state: FSMContext, command: CommandObject):
     await state.clear()
     if not is_admin(message.from_user.id):
         return
     lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
-    rows = await db.get_last_leads(20)
-    if not rows:
-        await message.answer(t("admin_empty", lang), reply_markup=Keyboards.admin(lang))
+    filters = parse_lead_filters(command.args or "")
+    if filters is None:
+        await message.answer(t("leads_usage", lang), reply_markup=Keyboards.admin(lang))
         return
+    lead_filters[message.from_user.id] = filters
+    await send_leads_page(message, lang)
+
 
-    lines = ["📋 <b>Последние заявки</b>\n" if lang == "ru" else "📋 <b>Oxirgi arizalar</b>\n"]
-    for r in rows:
-        status_emoji = {"new": "🆕", "work": "🔧", "paid": "💰", "shipped": "🚚", "closed": "✅"}.get(r["status"], "❓")
-        lines.append(
-            f"\n<b>#{r['id']}</b> {status_emoji} <code>{r['status']}</code>\n"
-            f"📅 {str(r['created_at'])[:16]} | {r['role']} | {r['product']}\n"
-            f"📍 {r['city']} | ☎️ {r['phone']}\n"
-            f"{'✓' if r['manager_notified'] else '✗'} | {r['user_id']}\n"
-            f"──────────────"
+@dp.callback_query(LeadsPage.filter())
+async def admin_leads_page(callback: CallbackQuery, callback_data: LeadsPage):
+    if not is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    lang = await get_user_lang(callback.from_user.id, callback.from_user.language_code)
+    chunks, markup = await render_leads_page(
+        callback.from_user.id, lang, callback_data.cursor, callback_data.newer
+    )
+    await callback.answer()
+    if not chunks:
+        return
+    if len(chunks) == 1 and isinstance(callback.message, Message):
+        await callback.message.edit_text(chunks[0], reply_markup=markup)
+        return
+    for i, chunk in enumerate(chunks):
+        await bot.send_message(
+            callback.from_user.id, chunk, reply_markup=markup if i == len(chunks) - 1 else None
         )
-    await message.answer("\n".join(lines), reply_markup=Keyboards.admin(lang))
 
 
-@dp.message(lambda m: (m.text or "").startswith("📊"))
-async def admin_stats(message: Message, state: FSMContext):
+@buttons.action("stats")
+async def admin_stats(message: Message, state: FSMContext, lang: str):
     await state.clear()
     if not is_admin(message.from_user.id):
         return
-    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
     s = await db.get_stats()
     text_ru = (
         "📊 <b>Статистика</b>\n\n"
@@ -923,6 +2611,83 @@ async def admin_stats(message: Message, state: FSMContext):
     await message.answer(text_ru if lang == "ru" else text_uz, reply_markup=Keyboards.admin(lang))
 
 
+def fts_query(text: str) -> Optional[str]:
+    """Каждое слово — отдельная фраза в кавычках (без синтаксиса FTS5), все обязательны."""
+    terms = [w.lstrip("@") for w in text.split()]
+    # trigram не находит фрагменты короче 3 символов
+    terms = [w for w in terms if len(w) >= 3]
+    if not terms:
+        return None
+    return " ".join('"' + w.replace('"', '""') + '"' for w in terms)
+
+
+async def render_find_page(admin_id: int, lang: str, offset: int = 0) -> tuple:
+    found = find_queries.get(admin_id)
+    if found is None:
+        return [], None
+    text, query = found
+    size = Config.LEADS_PAGE_SIZE
+    rows = await db.search_leads(query, offset, size)
+    if not rows:
+        return [], None
+    has_more = len(rows) > size
+    rows = rows[:size]
+
+    header = f"{t('find_title', lang)} {html.escape(text)}\n"
+    chunks = split_message([header] + [format_lead(r) for r in rows])
+
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton(
+            text="⬅️",
+            callback_data=FindPage(offset=max(offset - size, 0)).pack(),
+        ))
+    if has_more:
+        nav.append(InlineKeyboardButton(
+            text="➡️",
+            callback_data=FindPage(offset=offset + size).pack(),
+        ))
+    markup = InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+    return chunks, markup
+
+
+@dp.message(Command("find"))
+async def admin_find(message: Message, state: FSMContext, command: CommandObject):
+    await state.clear()
+    if not is_admin(message.from_user.id):
+        return
+    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
+    query = fts_query(command.args or "")
+    if query is None:
+        await message.answer(t("find_usage", lang), reply_markup=Keyboards.admin(lang))
+        return
+    find_queries[message.from_user.id] = (command.args.strip(), query)
+    chunks, markup = await render_find_page(message.from_user.id, lang)
+    if not chunks:
+        await message.answer(t("find_empty", lang), reply_markup=Keyboards.admin(lang))
+        return
+    for i, chunk in enumerate(chunks):
+        await message.answer(chunk, reply_markup=markup if i == len(chunks) - 1 else None)
+
+
+@dp.callback_query(FindPage.filter())
+async def admin_find_page(callback: CallbackQuery, callback_data: FindPage):
+    await callback.answer()
+    if not is_admin(callback.from_user.id):
+        return
+    lang = await get_user_lang(callback.from_user.id, callback.from_user.language_code)
+    chunks, markup = await render_find_page(callback.from_user.id, lang, callback_data.offset)
+    if not chunks:
+        return
+    if len(chunks) == 1 and isinstance(callback.message, Message):
+        await callback.message.edit_text(chunks[0], reply_markup=markup)
+        return
+    for i, chunk in enumerate(chunks):
+        await bot.send_message(
+            callback.from_user.id, chunk, reply_markup=markup if i == len(chunks) - 1 else None
+        )
+
+
 @dp.message(Command("status"))
 async def admin_set_status(message: Message, state: FSMContext):
     await state.clear()
@@ -938,7 +2703,7 @@ async def admin_set_status(message: Message, state: FSMContext):
 
     lead_id = int(parts[1])
     status = parts[2].lower().strip()
-    if status not in {"new", "work", "paid", "shipped", "closed"}:
+    if status not in STATUSES:
         await message.answer(t("admin_status_bad", lang), reply_markup=Keyboards.admin(lang))
         return
 
@@ -950,76 +2715,537 @@ async def admin_set_status(message: Message, state: FSMContext):
         await message.answer(f"❌ Заявка #{lead_id} не найдена", reply_markup=Keyboards.admin(lang))
 
 
-@dp.message(lambda m: (m.text or "") == "📤 Excel")
-async def admin_export(message: Message, state: FSMContext):
+@dp.message(Command("slow"))
+async def admin_slow(message: Message, state: FSMContext):
     await state.clear()
     if not is_admin(message.from_user.id):
         return
     lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
+    if not slow_traces:
+        await message.answer(
+            f"🐢 Медленных апдейтов (≥ {Config.SLOW_UPDATE_MS:.0f} ms) нет.",
+            reply_markup=Keyboards.admin(lang),
+        )
+        return
+    parts = [f"🐢 <b>Медленные апдейты</b> (≥ {Config.SLOW_UPDATE_MS:.0f} ms)\n"]
+    for ts, root in reversed(slow_traces):
+        tree = "\n".join(root.render())
+        parts.append(f"{ts.strftime('%d.%m %H:%M:%S')}\n<pre>{html.escape(tree)}</pre>")
+    for chunk in split_message(parts):
+        await message.answer(chunk, reply_markup=Keyboards.admin(lang))
+
+
+@dp.message(Command("archive"))
+async def admin_archive(message: Message, state: FSMContext, command: CommandObject):
+    """/archive — список месяцев, /archive 2025-01 [user_id] — сводка и события клиента."""
+    await state.clear()
+    if not is_admin(message.from_user.id):
+        return
+    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
+    args = (command.args or "").split()
+
+    if not args:
+        months = await asyncio.to_thread(list_archives, Config.ARCHIVE_DIR)
+        if not months:
+            text = "🗄 Архив активности пуст."
+        else:
+            lines = [f"• {m} — {size / 1024:.1f} KB" for m, size in months]
+            text = "🗄 <b>Архив активности</b>\n\n" + "\n".join(lines) + "\n\n/archive ГГГГ-ММ [user_id]"
+        await message.answer(text, reply_markup=Keyboards.admin(lang))
+        return
+
+    month = args[0]
+    user_id = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+    if not re.fullmatch(r"\d{4}-\d{2}", month):
+        await message.answer("Формат: /archive ГГГГ-ММ [user_id]", reply_markup=Keyboards.admin(lang))
+        return
+
+    counts, events = await asyncio.to_thread(read_archive, Config.ARCHIVE_DIR, month, user_id)
+    if counts is None:
+        await message.answer(f"🗄 За {month} архива нет.", reply_markup=Keyboards.admin(lang))
+        return
+    parts = [f"🗄 <b>Активность за {month}</b> — {sum(counts.values())}\n"]
+    for action, n in sorted(counts.items(), key=lambda kv: -kv[1]):
+        parts.append(f"• {html.escape(str(action))}: {n}")
+    if user_id is not None:
+        parts.append(f"\n👤 <b>{user_id}</b>: {len(events)}")
+        for rec in events[-50:]:
+            details = html.escape(str(rec["details"] or ""))[:100]
+            parts.append(f"{rec['timestamp']} {html.escape(str(rec['action']))} {details}")
+    for chunk in split_message(parts):
+        await message.answer(chunk, reply_markup=Keyboards.admin(lang))
 
-    try:
-        rows = await db.get_all_leads()
-        if not rows:
-            await message.answer(t("admin_empty", lang), reply_markup=Keyboards.admin(lang))
-            return
 
-        Config.EXPORTS_DIR.mkdir(exist_ok=True)
-        out = Config.EXPORTS_DIR / f"leads_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-        await create_excel(rows, out, "Leads")
+class ExportFormat(CallbackData, prefix="ex"):
+    fmt: str
+    delta: bool = False
 
-        await message.answer(t("admin_export_ok", lang), reply_markup=Keyboards.admin(lang))
-        await bot.send_document(
-            message.from_user.id,
-            FSInputFile(str(out)),
-            caption=f"📤 Экспорт от {datetime.now().strftime('%d.%m.%Y %H:%M')}",
+
+@buttons.action("export")
+async def admin_export(message: Message, state: FSMContext, lang: str):
+    await state.clear()
+    if not is_admin(message.from_user.id):
+        return
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=label, callback_data=ExportFormat(fmt=fmt).pack())
+            for fmt, (_, _, label) in EXPORT_FORMATS.items()
+        ],
+        [
+            InlineKeyboardButton(text=f"🆕 {label}", callback_data=ExportFormat(fmt=fmt, delta=True).pack())
+            for fmt, (_, _, label) in EXPORT_FORMATS.items()
+        ],
+    ])
+    await message.answer(t("export_choose", lang), reply_markup=markup)
+
+
+@dp.callback_query(ExportFormat.filter())
+async def admin_export_format(callback: CallbackQuery, callback_data: ExportFormat):
+    await callback.answer()
+    admin_id = callback.from_user.id
+    if not is_admin(admin_id) or callback_data.fmt not in EXPORT_FORMATS:
+        return
+    lang = await get_user_lang(admin_id, callback.from_user.language_code)
+
+    document = None
+    try:
+        # без водяного знака (первая выгрузка этого админа) дельта — это всё
+        since = await db.get_export_watermark(admin_id) if callback_data.delta else None
+        started = time.perf_counter()
+        count, document, size, mark = await build_export(callback_data.fmt, since=since)
+        elapsed = time.perf_counter() - started
+        if count == 0:
+            text = t("export_no_changes" if since else "admin_empty", lang)
+            await bot.send_message(admin_id, text, reply_markup=Keyboards.admin(lang))
+            return
+        if size > Config.EXPORT_MAX_UPLOAD_MB * 1024 * 1024:
+            await bot.send_message(admin_id, t("export_too_big", lang), reply_markup=Keyboards.admin(lang))
+            return
+        logger.info(
+            f"export {callback_data.fmt}{' delta' if since else ''}: {count} rows, {size} bytes in {elapsed:.2f}s"
         )
-        await db.log_activity(message.from_user.id, "export_excel", str(out))
+
+        await bot.send_message(admin_id, t("admin_export_ok", lang), reply_markup=Keyboards.admin(lang))
+        with send_priority(LANE_BULK):
+            await bot.send_document(
+                admin_id,
+                document,
+                caption=(f"{'🆕 Новые' if since else '📤 Экспорт'} от "
+                         f"{datetime.now().strftime('%d.%m.%Y %H:%M')} — {count}"),
+            )
+        # только после успешной отправки: иначе дельта повторится в следующий раз
+        await db.set_export_watermark(admin_id, mark)
+        await db.log_activity(admin_id, "export", f"{callback_data.fmt}{':delta' if since else ''}:{count}")
     except Exception:
         logger.exception("export failed")
-        await message.answer(t("admin_export_fail", lang), reply_markup=Keyboards.admin(lang))
+        await bot.send_message(admin_id, t("admin_export_fail", lang), reply_markup=Keyboards.admin(lang))
+    finally:
+        if isinstance(document, SpooledInputFile):
+            document.spool.close()
+
+
+@buttons.action("back")
+async def admin_back(message: Message, state: FSMContext, lang: str):
+    await state.clear()
+    text, markup = Screens.get("menu", lang, is_admin(message.from_user.id))
+    await message.answer(text, reply_markup=markup)
+
+
+buttons.rebuild()
+
+
+# =========================
+# BROADCAST
+# =========================
+BROADCAST_STATUS = {"running": "⏳ идёт", "done": "✅ завершена", "stopped": "⛔ остановлена"}
+
+
+def format_broadcast(b, status: Optional[str] = None) -> str:
+    sent = b["delivered"] + b["blocked"] + b["failed"]
+    filters = " ".join(f for f in (
+        f"lang={b['lang']}" if b["lang"] else "",
+        f"с {b['active_since'][:10]}" if b["active_since"] else "",
+    ) if f)
+    return (
+        f"📣 <b>Рассылка #{b['id']}</b> — {BROADCAST_STATUS.get(status or b['status'], b['status'])}\n"
+        + (f"🔎 {filters}\n" if filters else "")
+        + f"\n📬 {sent} / {b['total']}\n"
+        f"✅ Доставлено: {b['delivered']}\n"
+        f"🚫 Заблокировали: {b['blocked']}\n"
+        f"⚠️ Ошибки: {b['failed']}"
+    )
+
+
+class Broadcaster:
+    """Одна рассылка за раз, в фоне, в очереди LANE_BULK (ответы пользователям идут вперёд).
+
+    После каждой пачки в broadcasts пишется checkpoint (last_user_id и счётчики),
+    поэтому после рестарта рассылка продолжается с места остановки. Пачка,
+    прерванная на середине, будет отправлена повторно — не больше BROADCAST_BATCH.
+    """
+
+    def __init__(self, batch: int):
+        self.batch = batch
+        self.task: Optional[asyncio.Task] = None
+        self.broadcast_id: Optional[int] = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self, broadcast_id: int):
+        self.broadcast_id = broadcast_id
+        # чистый контекст: иначе задача унаследует span апдейта /broadcast и будет копить в нём
+        # дочерние span'ы всех отправок до конца рассылки
+        self.task = asyncio.create_task(self._run(broadcast_id), context=contextvars.Context())
+
+    async def resume(self):
+        b = await db.get_broadcast()
+        if b is not None:
+            logger.info(f"broadcast #{b['id']} resumed after user {b['last_user_id']}")
+            self.start(b["id"])
+
+    async def stop(self) -> Optional[int]:
+        if not self.running:
+            return None
+        broadcast_id = self.broadcast_id
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        await db.finish_broadcast(broadcast_id, "stopped")
+        await self._show_progress(await db.get_broadcast(broadcast_id))
+        return broadcast_id
+
+    async def _send(self, user_id: int, text: str) -> str:
+        try:
+            await bot.send_message(user_id, text)
+            return "delivered"
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramAPIError as e:
+            logger.warning(f"broadcast to {user_id} failed: {e}")
+            return "failed"
+
+    async def _show_progress(self, b):
+        if b is None or not b["progress_message_id"]:
+            return
+        try:
+            with send_priority(LANE_ADMIN):
+                await bot.edit_message_text(
+                    format_broadcast(b), chat_id=b["progress_chat_id"], message_id=b["progress_message_id"]
+                )
+        except TelegramAPIError as e:
+            # "message is not modified" и т.п. — прогресс не критичен
+            logger.debug(f"broadcast progress not updated: {e}")
+
+    async def _run(self, broadcast_id: int):
+        b = await db.get_broadcast(broadcast_id)
+        if b is None:
+            return
+        after = b["last_user_id"]
+        shown = time.monotonic()
+        started = time.perf_counter()
+        try:
+            with send_priority(LANE_BULK):
+                while True:
+                    user_ids = await db.get_recipients(b["lang"], b["active_since"], after, self.batch)
+                    if not user_ids:
+                        break
+                    results = await asyncio.gather(*(self._send(uid, b["text"]) for uid in user_ids))
+                    after = user_ids[-1]
+                    await db.checkpoint_broadcast(
+                        broadcast_id, after,
+                        results.count("delivered"), results.count("blocked"), results.count("failed"),
+                    )
+                    for outcome in ("delivered", "blocked", "failed"):
+                        metrics.inc("broadcast_messages_total", results.count(outcome), outcome=outcome)
+                    if time.monotonic() - shown >= Config.BROADCAST_PROGRESS_EVERY:
+                        shown = time.monotonic()
+                        await self._show_progress(await db.get_broadcast(broadcast_id))
+            await db.finish_broadcast(broadcast_id, "done")
+            b = await db.get_broadcast(broadcast_id)
+            logger.info(
+                f"broadcast #{broadcast_id} done in {time.perf_counter() - started:.0f}s: "
+                f"{b['delivered']} delivered, {b['blocked']} blocked, {b['failed']} failed"
+            )
+            await self._show_progress(b)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # статус остаётся running — продолжим со следующего checkpoint при рестарте
+            logger.exception(f"broadcast #{broadcast_id} crashed")
+
+
+broadcaster = Broadcaster(Config.BROADCAST_BATCH)
+
+
+def parse_broadcast_args(line: str) -> Optional[Dict[str, Any]]:
+    opts: Dict[str, Any] = {"lang": None, "active_since": None}
+    for token in line.split():
+        key, sep, value = token.partition("=")
+        if key == "lang" and value in TEXT:
+            opts["lang"] = value
+        elif key == "days" and value.isdigit():
+            since = datetime.utcnow() - timedelta(days=int(value))
+            opts["active_since"] = since.strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            return None
+    return opts
+
+
+@dp.message(Command("broadcast"))
+async def admin_broadcast(message: Message, state: FSMContext):
+    """/broadcast [lang=ru|uz] [days=N], со следующей строки — текст рассылки."""
+    await state.clear()
+    if not is_admin(message.from_user.id):
+        return
+    lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
+    first, _, body = (message.html_text or "").partition("\n")
+    opts = parse_broadcast_args(first.partition(" ")[2])
+    if opts is None or not body.strip():
+        await message.answer(
+            "Используйте:\n/broadcast [lang=ru|uz] [days=N]\nтекст рассылки (со следующей строки)\n\n"
+            "days — только клиенты, активные за последние N дней. Остановить: /broadcast_stop",
+            reply_markup=Keyboards.admin(lang),
+        )
+        return
+    if broadcaster.running:
+        await message.answer(
+            f"⏳ Уже идёт рассылка #{broadcaster.broadcast_id}. Остановить: /broadcast_stop",
+            reply_markup=Keyboards.admin(lang),
+        )
+        return
 
+    total = await db.count_recipients(opts["lang"], opts["active_since"])
+    if total == 0:
+        await message.answer("📭 Нет получателей под этот фильтр.", reply_markup=Keyboards.admin(lang))
+        return
+    broadcast_id = await db.create_broadcast(
+        message.from_user.id, body.strip(), opts["lang"], opts["active_since"], total
+    )
+    progress = await message.answer(format_broadcast(await db.get_broadcast(broadcast_id)))
+    await db.set_broadcast_progress_message(broadcast_id, progress.chat.id, progress.message_id)
+    await db.log_activity(message.from_user.id, "broadcast", f"#{broadcast_id} to {total}")
+    broadcaster.start(broadcast_id)
 
-@dp.message(lambda m: (m.text or "") in {BTN["ru"]["back"], BTN["uz"]["back"]})
-async def admin_back(message: Message, state: FSMContext):
+
+@dp.message(Command("broadcast_stop"))
+async def admin_broadcast_stop(message: Message, state: FSMContext):
     await state.clear()
+    if not is_admin(message.from_user.id):
+        return
     lang = await get_user_lang(message.from_user.id, message.from_user.language_code)
-    await message.answer(t("menu", lang), reply_markup=Keyboards.main(lang, is_admin(message.from_user.id)))
+    broadcast_id = await broadcaster.stop()
+    text = f"⛔ Рассылка #{broadcast_id} остановлена." if broadcast_id else "Активной рассылки нет."
+    await message.answer(text, reply_markup=Keyboards.admin(lang))
 
 
 # =========================
-# EXCEL
+# EXPORT
 # =========================
-async def create_excel(rows: List[aiosqlite.Row], filepath: Path, title: str = "Leads") -> Path:
-    wb = Workbook()
-    ws = wb.active
-    ws.title = title
+EXCEL_HEADERS = ["ID", "Дата", "Клиент", "Username", "Язык", "Тип", "Товар",
+                 "Кол-во", "Город", "Телефон", "Статус", "Уведомлен"]
+EXPORT_FIELDS = ("id", "created_at", "full_name", "username", "lang", "role", "product",
+                 "qty", "city", "phone", "status", "manager_notified")
+EXPORT_COLUMNS = ", ".join(EXPORT_FIELDS)
+
+
+def open_readonly(db_path: str) -> sqlite3.Connection:
+    return sqlite3.connect(readonly_uri(db_path), uri=True)
 
-    headers = ["ID", "Дата", "Клиент", "Username", "Язык", "Тип", "Товар",
-               "Кол-во", "Город", "Телефон", "Статус", "Уведомлен"]
-    ws.append(headers)
 
-    for cell in ws[1]:
+def iter_chunks(cur: sqlite3.Cursor):
+    while True:
+        chunk = cur.fetchmany(Config.EXPORT_FETCH_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+@contextlib.contextmanager
+def text_stream(out: BinaryIO, encoding: str = "utf-8"):
+    """Текстовая обёртка над out, которая не закрывает сам out."""
+    stream = io.TextIOWrapper(out, encoding=encoding, newline="")
+    try:
+        yield stream
+    finally:
+        stream.flush()
+        stream.detach()
+
+
+def encode_csv(cur: sqlite3.Cursor, out: BinaryIO, title: str) -> int:
+    count = 0
+    # BOM — чтобы Excel открыл кириллицу без мастера импорта
+    with text_stream(out, "utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(EXCEL_HEADERS)
+        for chunk in iter_chunks(cur):
+            writer.writerows(chunk)
+            count += len(chunk)
+    return count
+
+
+def encode_csv_gz(cur: sqlite3.Cursor, out: BinaryIO, title: str) -> int:
+    with gzip.GzipFile(filename=f"{title}.csv", fileobj=out, mode="wb", compresslevel=6) as gz:
+        return encode_csv(cur, gz, title)
+
+
+def encode_jsonl(cur: sqlite3.Cursor, out: BinaryIO, title: str) -> int:
+    count = 0
+    dumps = json.JSONEncoder(ensure_ascii=False).encode
+    with text_stream(out) as f:
+        for chunk in iter_chunks(cur):
+            f.write("".join(dumps(dict(zip(EXPORT_FIELDS, r))) + "\n" for r in chunk))
+            count += len(chunk)
+    return count
+
+
+def encode_xlsx(cur: sqlite3.Cursor, out: BinaryIO, title: str) -> int:
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+
+    def to_row(r) -> list:
+        return [*r[:11], "Да" if r[11] else "Нет"]
+
+    # в write-only режиме ширины задаются до первой строки — считаем по выборке
+    sample = [to_row(r) for r in cur.fetchmany(Config.EXPORT_WIDTH_SAMPLE)]
+    widths = [len(h) for h in EXCEL_HEADERS]
+    for row in sample:
+        for i, v in enumerate(row):
+            if v:
+                widths[i] = max(widths[i], len(str(v)))
+    for i, w in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(i)].width = min(w + 2, 50)
+
+    header = []
+    for h in EXCEL_HEADERS:
+        cell = WriteOnlyCell(ws, value=h)
         cell.font = Font(bold=True, color="FFFFFF")
         cell.fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
         cell.alignment = Alignment(horizontal="center")
+        header.append(cell)
+    ws.append(header)
+
+    count = 0
+    for row in sample:
+        ws.append(row)
+        count += 1
+    for chunk in iter_chunks(cur):
+        for r in chunk:
+            ws.append(to_row(r))
+            count += 1
+
+    wb.save(out)
+    return count
+
+
+# формат -> (кодировщик, расширение, подпись кнопки)
+EXPORT_FORMATS = {
+    "csv": (encode_csv, "csv", "CSV"),
+    "csvgz": (encode_csv_gz, "csv.gz", "CSV.gz"),
+    "jsonl": (encode_jsonl, "jsonl", "JSONL"),
+    "xlsx": (encode_xlsx, "xlsx", "Excel"),
+}
+
+
+def write_leads(db_path: str, fmt: str, out: BinaryIO, title: str = "Leads",
+                start: Optional[str] = None, end: Optional[str] = None) -> int:
+    """Потоковая выгрузка leads в out в формате fmt. Выполняется вне event loop."""
+    sql = f"SELECT {EXPORT_COLUMNS} FROM leads"
+    params: tuple = ()
+    if start and end:
+        sql += " WHERE created_at >= ? AND created_at <= ?"
+        params = (start, end)
+    sql += " ORDER BY id DESC"
+
+    encode = EXPORT_FORMATS[fmt][0]
+    conn = open_readonly(db_path)
+    try:
+        return encode(conn.execute(sql, params), out, title)
+    finally:
+        conn.close()
+
+
+def write_leads_since(db_path: str, fmt: str, out: BinaryIO, title: str = "Leads",
+                      since: Optional[tuple] = None) -> tuple:
+    """Все заявки (since=None) или только новые/сменившие статус после since=(id, время).
+
+    Данные и новый водяной знак берутся из одного read-снимка, поэтому заявки,
+    записанные во время выгрузки, попадут в следующую дельту, а не потеряются.
+    Возвращает (число строк, водяной знак).
+    """
+    encode = EXPORT_FORMATS[fmt][0]
+    conn = open_readonly(db_path)
+    try:
+        conn.execute("BEGIN")
+        # отдельные подзапросы: MAX по индексу работает только для одиночного агрегата
+        hi_id, hi_ts = conn.execute(
+            "SELECT COALESCE((SELECT MAX(id) FROM leads), 0),"
+            " COALESCE((SELECT MAX(status_updated_at) FROM leads), '')"
+        ).fetchone()
+        if since is None:
+            sql = f"SELECT {EXPORT_COLUMNS} FROM leads WHERE id <= ? ORDER BY id DESC"
+            params: tuple = (hi_id,)
+        else:
+            # два диапазона по индексам (rowid и idx_leads_status_updated), UNION убирает повторы
+            sql = f"""
+                SELECT {EXPORT_COLUMNS} FROM leads WHERE id > ? AND id <= ?
+                UNION
+                SELECT {EXPORT_COLUMNS} FROM leads
+                WHERE status_updated_at > ? AND status_updated_at <= ?
+                ORDER BY id DESC
+            """
+            params = (since[0], hi_id, since[1], hi_ts)
+        count = encode(conn.execute(sql, params), out, title)
+        return count, (hi_id, hi_ts)
+    finally:
+        conn.close()
+
+
+async def create_excel(filepath: Path, title: str = "Leads",
+                       start: Optional[str] = None, end: Optional[str] = None) -> int:
+    def run() -> int:
+        with open(filepath, "wb") as f:
+            return write_leads(db.db_path, "xlsx", f, title, start, end)
+
+    return await asyncio.to_thread(run)
+
 
-    for r in rows:
-        ws.append([
-            r["id"], r["created_at"], r["full_name"], r["username"], r["lang"],
-            r["role"], r["product"], r["qty"], r["city"], r["phone"],
-            r["status"], "Да" if r["manager_notified"] else "Нет"
-        ])
+class SpooledInputFile(InputFile):
+    """Отдаёт содержимое уже записанного spool-файла (в т.ч. сброшенного на диск) кусками."""
 
-    for col in ws.columns:
-        max_len = 0
-        col_letter = col[0].column_letter
-        for cell in col:
-            if cell.value:
-                max_len = max(max_len, len(str(cell.value)))
-        ws.column_dimensions[col_letter].width = min(max_len + 2, 50)
+    def __init__(self, spool: BinaryIO, filename: str):
+        super().__init__(filename)
+        self.spool = spool
 
-    wb.save(filepath)
-    return filepath
+    async def read(self, bot: Bot):
+        # с начала: OutboundLimiter может повторить загрузку
+        self.spool.seek(0)
+        while chunk := await asyncio.to_thread(self.spool.read, self.chunk_size):
+            yield chunk
+
+
+async def build_export(fmt: str, title: str = "Leads", since: Optional[tuple] = None) -> tuple:
+    """(число строк, InputFile, размер, водяной знак). Файл собирается в
+    SpooledTemporaryFile: до EXPORT_SPOOL_MB — только в памяти, крупнее — во
+    временном файле, который удаляется при закрытии.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=Config.EXPORT_SPOOL_MB * 1024 * 1024)
+    try:
+        count, mark = await asyncio.to_thread(write_leads_since, db.db_path, fmt, spool, title, since)
+        size = spool.tell()
+    except BaseException:
+        spool.close()
+        raise
+    filename = f"leads_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{EXPORT_FORMATS[fmt][1]}"
+    if size <= Config.EXPORT_SPOOL_MB * 1024 * 1024:
+        spool.seek(0)
+        data = spool.read()
+        spool.close()
+        return count, BufferedInputFile(data, filename), size, mark
+    return count, SpooledInputFile(spool, filename), size, mark
 
 
 # =========================
@@ -1040,11 +3266,9 @@ async def send_monthly_report():
     last_day = monthrange(year, month)[1]
     end_date = f"{year}-{month:02d}-{last_day} 23:59:59"
 
-    rows = await db.get_leads_by_date_range(start_date, end_date)
-
     Config.REPORTS_DIR.mkdir(exist_ok=True)
     filename = Config.REPORTS_DIR / f"monthly_report_{year}_{month:02d}.xlsx"
-    await create_excel(rows, filename, f"Report_{month:02d}_{year}")
+    await create_excel(filename, f"Report_{month:02d}_{year}", start_date, end_date)
 
     intro = (
         f"<b>📊 МЕСЯЧНЫЙ ОТЧЕТ — {stats['period']}</b>\n\n"
@@ -1061,12 +3285,13 @@ async def send_monthly_report():
 
     for admin_id in Config.ADMIN_IDS:
         try:
-            await bot.send_message(admin_id, intro)
-            await bot.send_document(
-                admin_id,
-                FSInputFile(str(filename)),
-                caption=f"📊 Полный отчет за {stats['period']}\nФайл: {filename.name}",
-            )
+            with send_priority(LANE_BULK):
+                await bot.send_message(admin_id, intro)
+                await bot.send_document(
+                    admin_id,
+                    FSInputFile(str(filename)),
+                    caption=f"📊 Полный отчет за {stats['period']}\nФайл: {filename.name}",
+                )
         except TelegramAPIError as e:
             logger.error(f"monthly report send failed: {e}")
 
@@ -1074,29 +3299,114 @@ async def send_monthly_report():
 
 
 # =========================
-# CLEANUP & BACKUP
+# BACKUP
 # =========================
-async def cleanup_old_files():
+def write_backup(db_path: str, backup_dir: Path) -> Path:
+    """Снимок через online backup API (учитывает WAL), проверка и gzip. Вне event loop."""
+    backup_dir.mkdir(exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    raw = backup_dir / f"backup_{stamp}.db.tmp"
+    out = backup_dir / f"backup_{stamp}.db.gz"
+
+    src = open_readonly(db_path)
+    dst = sqlite3.connect(raw)
     try:
-        Config.EXPORTS_DIR.mkdir(exist_ok=True)
-        cutoff = datetime.now() - timedelta(days=Config.MAX_EXPORT_AGE_DAYS)
-        for file in Config.EXPORTS_DIR.glob("*.xlsx"):
-            if datetime.fromtimestamp(file.stat().st_mtime) < cutoff:
-                file.unlink()
-    except Exception as e:
-        logger.error(f"cleanup error: {e}")
+        # один шаг (pages=-1) = один read-снимок: в WAL писателей не блокирует. Пошаговое
+        # копирование начиналось бы заново после каждой чужой записи и под нагрузкой бота
+        # могло не закончиться никогда
+        src.backup(dst, pages=-1)
+        check = dst.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        dst.close()
+        src.close()
+
+    try:
+        if check != "ok":
+            raise RuntimeError(f"backup integrity check failed: {check}")
+        with open(raw, "rb") as f_in, gzip.open(out, "wb", compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    finally:
+        raw.unlink(missing_ok=True)
+
+    backups = sorted(backup_dir.glob("backup_*.db*"), key=lambda p: p.stat().st_mtime)
+    for old in backups[:-Config.BACKUP_KEEP_COUNT]:
+        old.unlink()
+    return out
+
+
+def archive_path(archive_dir: Path, month: str) -> Path:
+    return archive_dir / f"activity_{month}.jsonl.gz"
+
+
+def append_archive(archive_dir: Path, rows: List[tuple]) -> None:
+    """Дописывает строки в месячные архивы. Каждый вызов — отдельный gzip-member."""
+    archive_dir.mkdir(exist_ok=True)
+    by_month: Dict[str, List[str]] = {}
+    for id_, ts, user_id, action, details in rows:
+        line = json.dumps(
+            {"id": id_, "timestamp": ts, "user_id": user_id, "action": action, "details": details},
+            ensure_ascii=False,
+        )
+        by_month.setdefault(ts[:7], []).append(line)
+    for month, lines in by_month.items():
+        with open(archive_path(archive_dir, month), "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as gz:
+                gz.write(("\n".join(lines) + "\n").encode("utf-8"))
+            # строки удаляются из БД только после того, как архив на диске
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+def read_archive(archive_dir: Path, month: str, user_id: Optional[int] = None) -> tuple:
+    """(счётчики по action, события user_id) за месяц. Повторы после сбоя отбрасываются по id."""
+    path = archive_path(archive_dir, month)
+    if not path.exists():
+        return None, []
+    seen = set()
+    counts: Dict[str, int] = {}
+    events = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec["id"] in seen:
+                continue
+            seen.add(rec["id"])
+            counts[rec["action"]] = counts.get(rec["action"], 0) + 1
+            if user_id is not None and rec["user_id"] == user_id:
+                events.append(rec)
+    return counts, events
+
+
+def list_archives(archive_dir: Path) -> List[tuple]:
+    return [
+        (p.name[len("activity_"):-len(".jsonl.gz")], p.stat().st_size)
+        for p in sorted(archive_dir.glob("activity_*.jsonl.gz"))
+    ]
+
+
+async def archive_activity() -> int:
+    """Переносит activity_log старше ACTIVITY_RETENTION_DAYS в архив, удаляя пачками."""
+    cutoff = (datetime.utcnow() - timedelta(days=Config.ACTIVITY_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    total = 0
+    while True:
+        rows = await db.get_activity_before(cutoff, Config.ACTIVITY_ARCHIVE_BATCH)
+        if not rows:
+            break
+        await asyncio.to_thread(append_archive, Config.ARCHIVE_DIR, [tuple(r) for r in rows])
+        total += await db.delete_activity([r["id"] for r in rows])
+        metrics.inc("activity_archived_total", len(rows))
+        # короткая пауза, чтобы пользовательские записи не стояли в очереди за архивацией
+        await asyncio.sleep(Config.ACTIVITY_ARCHIVE_PAUSE)
+    if total:
+        logger.info(f"activity archived: {total} rows older than {cutoff}")
+    return total
 
 
 async def backup_database():
     try:
-        Config.BACKUP_DIR.mkdir(exist_ok=True)
-        backup_path = Config.BACKUP_DIR / f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        import shutil
-        shutil.copy(Config.DB_PATH, backup_path)
-
-        backups = sorted(Config.BACKUP_DIR.glob("*.db"), key=lambda p: p.stat().st_mtime)
-        for old in backups[:-Config.BACKUP_KEEP_COUNT]:
-            old.unlink()
+        started = time.perf_counter()
+        out = await asyncio.to_thread(write_backup, db.db_path, Config.BACKUP_DIR)
+        logger.info(f"backup {out.name}: {out.stat().st_size} bytes in {time.perf_counter() - started:.1f} s")
     except Exception as e:
         logger.error(f"backup error: {e}")
 
@@ -1104,20 +3414,65 @@ async def backup_database():
 # =========================
 # WEB SERVER
 # =========================
-async def start_web_server():
+async def start_web_server(webhook: bool = False) -> web.AppRunner:
     app = web.Application()
 
     async def health(_request):
         return web.Response(text="OK", status=200)
 
+    async def metrics_endpoint(_request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
     app.router.add_get("/", health)
     app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics_endpoint)
+
+    if webhook:
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=Config.WEBHOOK_SECRET,
+        ).register(app, path=Config.WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
 
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", Config.PORT)
     await site.start()
     logger.info(f"Health server: 0.0.0.0:{Config.PORT}")
+    return runner
+
+
+async def setup_webhook() -> bool:
+    if Config.UPDATES_MODE != "webhook":
+        return False
+    if not Config.WEBHOOK_BASE_URL:
+        logger.warning("UPDATES_MODE=webhook, но WEBHOOK_BASE_URL не задан — используем polling")
+        return False
+    url = Config.WEBHOOK_BASE_URL + Config.WEBHOOK_PATH
+    try:
+        await bot.set_webhook(
+            url,
+            secret_token=Config.WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True,
+        )
+    except TelegramAPIError as e:
+        logger.error(f"set_webhook failed, falling back to polling: {e}")
+        return False
+    logger.info(f"Webhook set: {url}")
+    return True
+
+
+async def wait_for_shutdown():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await stop.wait()
 
 
 # =========================
@@ -1125,24 +3480,43 @@ async def start_web_server():
 # =========================
 async def main():
     await db.connect()
-    await cleanup_old_files()
 
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(cleanup_old_files, "cron", hour=3, minute=0)
-    scheduler.add_job(backup_database, "cron", hour=2, minute=0)
-    scheduler.add_job(send_monthly_report, "cron", day="last", hour=23, minute=0)
+    scheduler.add_job(timed_job(backup_database), "cron", hour=2, minute=0)
+    scheduler.add_job(timed_job(fsm_storage.sweep), "interval", minutes=30)
+    scheduler.add_job(timed_job(db.reconcile_stats), "cron", hour=4, minute=0)
+    # до бэкапа, чтобы снимок был меньше
+    scheduler.add_job(timed_job(archive_activity), "cron", hour=1, minute=30)
+    scheduler.add_job(timed_job(send_monthly_report), "cron", day="last", hour=23, minute=0)
     # страховка: если бот был выключен в последний день
-    scheduler.add_job(send_monthly_report, "date", run_date=datetime.now() + timedelta(seconds=30))
+    scheduler.add_job(timed_job(send_monthly_report), "date", run_date=datetime.now() + timedelta(seconds=30))
     scheduler.start()
-
-    await bot.delete_webhook(drop_pending_updates=True)
+    await broadcaster.resume()
 
     logger.info(f"Bot start. Admins={Config.ADMIN_IDS} Channel=@{Config.CHANNEL}")
 
-    await asyncio.gather(
-        start_web_server(),
-        dp.start_polling(bot, skip_updates=True)
-    )
+    webhook = await setup_webhook()
+    runner = await start_web_server(webhook)
+    try:
+        if webhook:
+            await wait_for_shutdown()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            # очередь чатов сама держит параллелизм; без задач на апдейт polling ждёт места в ней
+            await dp.start_polling(bot, skip_updates=True, handle_as_tasks=Config.UPDATE_WORKERS <= 0)
+    finally:
+        await runner.cleanup()
+        await update_executor.join(timeout=10)
+        # polling/webhook уже закрыли сессию, а дообработанные апдейты могли открыть новую
+        await bot.session.close()
+        scheduler.shutdown(wait=False)
+        if broadcaster.running:
+            # без смены статуса: продолжится после рестарта
+            broadcaster.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await broadcaster.task
+        await fsm_storage.close()
+        await db.close()
 
 
 if __name__ == "__main__":